@@ -0,0 +1,185 @@
+#! /usr/bin/python
+
+import os, sys
+import time
+import json
+import argparse
+import resource
+import subprocess
+
+# run without a display when Qt supports it (Qt4 needs a virtual X server: xvfb-run)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+
+# screen sizes used to measure the render latency
+SIZES = ( (1920,1080), (1280,800), (1024,768) )
+
+# maximal number of pages rendered for each size
+MAX_PAGES = 50
+
+
+def percentiles(values):
+    "Summarize a list of durations (in ms)"
+    if not values:
+        return None
+    values = sorted(values)
+    def pick(p):
+        return values[ min(len(values)-1, int(p * len(values))) ]
+    return {
+        "count": len(values),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": values[-1],
+    }
+
+def timed(f, *args):
+    "Call a function, return its result and the elapsed time in ms"
+    start = time.time()
+    result = f(*args)
+    return result, 1000 * (time.time() - start)
+
+
+def bench_document(filename, sizes, max_pages):
+    "Document level measures: no application, no cache"
+    from doc import Document
+
+    result = {}
+    # no background indexing competing with the renders for the document lock
+    doc, result["load_time"] = timed(Document, filename, False, None, False, False)
+    ignored, result["scan_time"] = timed(doc.scan, None, True)
+    result["pages"] = doc.lastPage
+    result["layout"] = len(doc.layout)
+
+    pages = [ info for info in doc.pages if info ][:max_pages]
+    result["render"] = {}
+    for width,height in sizes:
+        times = [ timed(info.render_image, width, height)[1] for info in pages ]
+        result["render"]["%dx%d" % (width,height)] = percentiles(times)
+    doc.close()
+    return result
+
+
+def bench_application(filename, max_pages):
+    "Drive a headless application: links, overview and navigation"
+    import pdfpc
+
+    result = {}
+    app, result["app_time"] = timed(pdfpc.Application, filename)
+    app.processEvents()
+    app.doc.scan(None, True)
+    # show the complete document and stop the scan timer
+    app.prefetch()
+    app.scan()
+
+    # measure on a quiet document: let the indexers finish, then forget what they found
+    app.doc.indexer.join()
+    app.doc.text_index.thread.join()
+    pages = [ info for info in app.doc.pages if info ][:max_pages]
+    for info in pages:
+        info.links = info.media = info.videos = info.hit_index = None
+    # media sources need the application
+    result["links_time"] = sum( timed(info.get_links)[1] for info in pages )
+    result["videos_time"] = sum( timed(info.get_videos)[1] for info in pages )
+
+    # repaints wait for the next frame: paint them before stopping the clock
+    def overview():
+        app.overview()
+        app.processEvents()
+        app.scheduler.flush()
+    ignored, result["overview_time"] = timed(overview)
+    app.overview(True)
+    app.processEvents()
+
+    # leave time for the background renders between two moves, as a speaker would
+    def move():
+        app.next()
+        app.processEvents()
+        app.scheduler.flush()
+    times = []
+    for i in range(max_pages):
+        app.renderer.pool.waitForDone()
+        times.append( timed(move)[1] )
+    result["navigation"] = percentiles(times)
+    result["cache"] = app.renderer.get_stats()
+
+    app.doc.close()
+    return result
+
+
+def bench_file(filename, sizes, max_pages, disk_cache):
+    import render
+    if not disk_cache:
+        render.DISK_CACHE_SIZE = 0
+
+    result = { "file": filename }
+    result.update( bench_document(filename, sizes, max_pages) )
+    result.update( bench_application(filename, max_pages) )
+    # kilobytes on linux
+    result["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def run_isolated(filename, args):
+    "Measure a file in a separate process: one Qt application each, separate memory peaks"
+    cmd = [ sys.executable, os.path.abspath(__file__), "--single", "--pages", str(args.pages) ]
+    if args.disk_cache:
+        cmd.append("--disk-cache")
+    for width,height in args.sizes:
+        cmd.extend( ["--size", "%dx%d" % (width,height)] )
+    cmd.append(filename)
+
+    output = subprocess.check_output(cmd)
+    return json.loads( output.decode("utf-8").strip().split("\n")[-1] )
+
+
+def show(result):
+    print( "%s: %d pages, %d slides" % (result["file"], result["pages"], result["layout"]) )
+    print( "  load       %8.1f ms (scan %.1f ms)" % (result["load_time"], result["scan_time"]) )
+    for size in sorted(result["render"]):
+        r = result["render"][size]
+        if r:
+            print( "  render %-10s p50 %7.1f  p90 %7.1f  p99 %7.1f ms" % (size, r["p50"], r["p90"], r["p99"]) )
+    print( "  links      %8.1f ms, videos %.1f ms" % (result["links_time"], result["videos_time"]) )
+    print( "  overview   %8.1f ms" % result["overview_time"] )
+    nav = result["navigation"]
+    if nav:
+        print( "  navigation p50 %7.1f  p90 %7.1f  p99 %7.1f ms" % (nav["p50"], nav["p90"], nav["p99"]) )
+    cache = result["cache"]
+    total = cache["hits"] + cache["misses"]
+    if total:
+        print( "  cache hits %7.1f %%" % (100.0 * cache["hits"] / total) )
+    print( "  memory     %8d KB" % result["max_rss"] )
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the performance of pdfpc on a set of PDF files")
+    parser.add_argument("files", nargs="+", help="PDF files to measure")
+    parser.add_argument("--size", dest="sizes", action="append", type=parse_size, help="render size (WxH), can be repeated")
+    parser.add_argument("--pages", type=int, default=MAX_PAGES, help="maximal number of pages to render")
+    parser.add_argument("--disk-cache", action="store_true", help="keep the persistent cache enabled")
+    parser.add_argument("--json", help="save the results in a JSON file")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.sizes:
+        args.sizes = SIZES
+
+    if args.single:
+        result = bench_file(args.files[0], args.sizes, args.pages, args.disk_cache)
+        print( json.dumps(result) )
+        sys.exit()
+
+    results = []
+    for filename in args.files:
+        result = run_isolated(filename, args)
+        show(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump( {"version": 1, "results": results}, f, indent=2 )
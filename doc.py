@@ -1,88 +1,393 @@
 import os, sys
 import time
+import hashlib
+import traceback
+import threading
+import collections
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 import popplerqt4
+from PyQt4 import QtCore
 import gui
+import render
+import timing
+import search
+import embedded
 
 
 # label for automatic note detection
 NOTE_LABEL = "0"
 
+# number of pages scanned before showing the first slide,
+# the others are scanned in the background
+SCAN_START = 8
+
+# number of poppler pages kept open, the others are reopened on demand
+PAGE_HANDLES = 32
+
+# number of rows and columns in the grid used to find links under the mouse
+HIT_GRID = 16
+
+# resolution of the render used to detect changed pages when reloading
+FINGERPRINT_DPI = 12
+
+# transitions of the PDF file, played as one of the built-in transitions
+PT = popplerqt4.Poppler.PageTransition
+TRANSITIONS = {
+    PT.Fade: "fade", PT.Dissolve: "fade", PT.Glitter: "fade",
+    PT.Push: "push", PT.Cover: "push", PT.Uncover: "push", PT.Fly: "push",
+    PT.Wipe: "wipe", PT.Split: "wipe", PT.Blinds: "wipe", PT.Box: "wipe",
+}
+del(PT)
+
+def read_transition(page):
+    "Transition of a poppler page: (kind, duration in seconds, direction)"
+    kind, duration, direction = None, 0, 1
+    transition = page.transition()
+    if transition:
+        kind = TRANSITIONS.get( transition.type() )
+        duration = getattr(transition, "durationReal", transition.duration)()
+        # moving from right to left: the new slide comes from the right
+        if transition.angle() != 180:
+            direction = -1
+    return (kind, duration, direction)
+
 
 class Document:
     """The document wrapper:
         * load the file
-        * provides a list of pages
+        * provides a list of pages, scanned in the background
+        * index links, media and text in the background
         * remember the current and frozen pages
+        * reuse the images of unchanged pages from a previous version
     """
     
-    def __init__(self, filename):
+    def __init__(self, filename, watch=False, previous=None, in_process=False, interactive=True):
         try:
             self.doc = popplerqt4.Poppler.Document.load(filename)
+            if self.doc is None:
+                raise IOError(filename)
         except:
+            if previous:
+                # keep the previous version: the file may still be written
+                raise IOError("Error loading the file")
             print( "Error loading the file" )
             sys.exit()
         
+        self.filename = filename
         self.basedir = os.path.dirname(filename)
+        # poppler is not thread safe: serialize calls from the render threads
+        self.lock = threading.RLock()
+        self.closed = False
+        
+        # fingerprint the pages to compare them with the next version,
+        # in the background: indexer when watching, matcher when reloading
+        self.watch = watch
+        self.fingerprints = {}
+        
+        self.file_key = render.get_file_key(filename)
+        # batch use (export, benchmarks): no disk cache, video extraction nor background indexing
+        self.interactive = interactive
+        self.disk_cache = None
+        if render.DISK_CACHE_SIZE and interactive:
+            self.disk_cache = render.DiskCache(self.file_key)
+        if previous:
+            self.cache = previous.cache
+            self.renderer = previous.renderer
+            self.media_manager = previous.media_manager
+            self.media_manager.doc = self
+        else:
+            self.cache = render.ImageCache()
+            self.renderer = None
+            self.media_manager = None
+            if interactive:
+                self.media_manager = embedded.MediaManager(self)
+        self.text_index = search.TextIndex(self)
+        self.server = None
+        if render.RENDER_PROCESSES and not in_process:
+            self.server = render.RenderServer(filename)
         self.lastPage = self.doc.numPages()
         
         self.note_vertical = False
         self.note_horizontal = False
         self.note_first = False
         self.note_end = False
+        self.note_mode = "page"
         
         if filename.endswith(".right.pdf"):
             self.note_horizontal = True
+            self.note_mode = "right"
         elif filename.endswith(".left.pdf"):
             self.note_horizontal = True
             self.note_first = True
+            self.note_mode = "left"
         elif filename.endswith(".bottom.pdf"):
             self.note_vertical = True
+            self.note_mode = "bottom"
         elif filename.endswith(".top.pdf"):
             self.note_vertical = True
             self.note_first = True
+            self.note_mode = "top"
         elif filename.endswith(".end.pdf"):
             # the second half of pages are note pages (LibreOffice export)
             self.note_end = True
-            self.lastPage /= 2
+            self.note_mode = "end"
+            self.lastPage //= 2
         elif filename.endswith(".notes.pdf"):
             # note pages in between regular pages
             pass
         
         if NOTE_LABEL is None or self.note_horizontal or self.note_vertical or self.note_end:
-            search_note = False
+            self.search_note = False
         else:
-            search_note = True
+            self.search_note = True
+        
+        # enable anti aliasing
+        self.set_antialias(True)
         
-        # detect overlays and inline note pages
-        prev = None
+        # load pages in the background, link them as they arrive
+        self.page_handles = collections.OrderedDict()
         self.layout = []
+        self.labels = {}
         self.pages = []
-        for p in range(self.lastPage):
-            page = self.doc.page(p)
-            if search_note and page.label() == NOTE_LABEL:
-                prev.set_note_page(page)
+        self.last = None
+        self.complete = self.lastPage < 1
+        self.load_error = None
+        self.ready = False
+        self.loaded = queue.Queue()
+        self.loader = threading.Thread(target=self.load_pages)
+        self.loader.daemon = True
+        self.loader.start()
+        self.scan(SCAN_START, True)
+        
+        if self.load_error and (previous or not self.layout):
+            self.close()
+            if previous:
+                raise IOError(self.load_error)
+            print( self.load_error )
+            sys.exit()
+        self.ready = True
+        if self.load_error and self.complete:
+            self.finish()
+        
+        if previous:
+            self.matcher = threading.Thread(target=self.match_pages, args=(previous,))
+            self.matcher.daemon = True
+            self.matcher.start()
+    
+    def set_antialias(self, enabled):
+        self.doc.setRenderHint(popplerqt4.Poppler.Document.TextAntialiasing, enabled)
+        self.doc.setRenderHint(popplerqt4.Poppler.Document.Antialiasing, enabled)
+    
+    def get_page(self, index):
+        "Open a poppler page, only the most recently used ones are kept"
+        with self.lock:
+            page = self.page_handles.pop(index, None)
+            if page is None:
+                page = self.doc.page(index)
+            self.page_handles[index] = page
+            while len(self.page_handles) > PAGE_HANDLES:
+                self.page_handles.popitem(False)
+            return page
+    
+    def close(self):
+        "Stop the background work on this version of the document"
+        self.closed = True
+        if self.server:
+            self.server.stop()
+    
+    def load_pages(self):
+        "Background thread: retrieve the properties of the pages"
+        try:
+            for p in range(self.lastPage):
+                if self.closed:
+                    break
+                with self.lock:
+                    page = self.get_page(p)
+                    if page is None:
+                        raise IOError("Error loading page %d" % (p+1))
+                    label = page.label()
+                    size = page.pageSize()
+                    transition = read_transition(page)
+                self.loaded.put( (p, label, size.width(), size.height(), transition) )
+        except Exception as e:
+            traceback.print_exc()
+            self.load_error = str(e)
+        finally:
+            # wakes up scan() if the last page was not reached
+            self.loaded.put(None)
+    
+    def scan(self, count=None, block=False):
+        """Detect overlays and inline note pages among the loaded pages.
+        Returns True if some pages were added.
+        """
+        added = False
+        while not self.complete and (count is None or count > 0):
+            try:
+                item = self.loaded.get(block)
+            except queue.Empty:
+                break
+            if item is None:
+                # the loader stopped early: keep the pages before the broken one,
+                # unless the constructor gives up on this version
+                self.complete = True
+                if self.ready:
+                    self.finish()
+                break
+            p, label, width, height, transition = item
+            
+            if count is not None:
+                count -= 1
+            added = True
+            
+            if self.search_note and label == NOTE_LABEL:
+                self.last.note_index = p
                 self.pages.append(None)
-                continue
-            info = PageInfo(self, page, prev)
-            prev = info
-            self.pages.append(info)
-            if info.overlay.count == 1:
-                self.layout.append(info)
+            else:
+                info = PageInfo(self, self.last, p, label, width, height, transition)
+                self.last = info
+                self.pages.append(info)
+                if info.overlay.count == 1:
+                    self.layout.append(info)
+                    self.labels.setdefault(u"%s" % label, info)
+                
+                if self.note_end:
+                    info.note_index = p+self.lastPage
             
-            if self.note_end:
-                notepage = self.doc.page(p+self.lastPage)
-                prev.set_note_page(notepage)
+            # only mark completion once the last page is in place
+            self.complete = p >= self.lastPage-1
+            if self.complete:
+                self.finish()
         
-        # enable anti aliasing
-        self.doc.setRenderHint(popplerqt4.Poppler.Document.TextAntialiasing)
-        self.doc.setRenderHint(popplerqt4.Poppler.Document.Antialiasing)
+        return added
     
+    def finish(self):
+        "Once all pages are scanned"
+        # all link targets are known: rebuild the partial hit indexes, index links and media
+        for info in self.pages:
+            if info is not None and info.links is None:
+                info.hit_index = None
+        if not self.interactive:
+            return
+        self.indexer = threading.Thread(target=self.index_pages)
+        self.indexer.daemon = True
+        self.indexer.start()
+        self.text_index.start()
+    
+    def find_slide(self, text):
+        "Find a slide by label, or by number, None if there is none"
+        info = self.labels.get(text)
+        if info is None and text.isdigit():
+            n = int(text)
+            if 0 < n <= len(self.layout):
+                info = self.layout[n-1]
+        return info
+    
+    def get_fingerprint(self, info, note):
+        "Content hash of the page showing the slide or its notes, computed on first use"
+        index = info.index
+        if note and info.note_index is not None:
+            index = info.note_index
+        with self.lock:
+            fingerprint = self.fingerprints.get(index)
+            if fingerprint is None:
+                fingerprint = self.fingerprints[index] = get_fingerprint(self.get_page(index))
+        return fingerprint
+    
+    def has_notes(self, info):
+        return info.note_index is not None or info.note_box is not None
+    
+    def match(self, old, info):
+        "Take over the images of a page of the previous version if it did not change"
+        for note in (False, True):
+            if note and not self.has_notes(info):
+                continue
+            fingerprint = self.get_fingerprint(info, note)
+            if fingerprint == old.doc.get_fingerprint(old, note):
+                self.renderer.share(old, info, note)
+    
+    def match_pages(self, previous):
+        """Background thread: take over the images of the pages identical
+        to a page of the previous version, then release the others
+        """
+        try:
+            # the first page with each content
+            old_pages = {}
+            for old in reversed(previous.pages):
+                if self.closed:
+                    return
+                if old is None:
+                    continue
+                for note in (False, True):
+                    if not note or previous.has_notes(old):
+                        old_pages[ (previous.get_fingerprint(old, note), note) ] = old
+            
+            i = 0
+            while not self.closed:
+                complete = self.complete
+                # an inline note page may follow the last scanned page
+                while i < len(self.pages) - (0 if complete else 1):
+                    info = self.pages[i]
+                    i += 1
+                    if info is None:
+                        continue
+                    for note in (False, True):
+                        if note and not self.has_notes(info):
+                            continue
+                        old = old_pages.get( (self.get_fingerprint(info, note), note) )
+                        if old:
+                            self.renderer.share(old, info, note)
+                if complete:
+                    break
+                time.sleep(0.1)
+        except:
+            traceback.print_exc()
+        finally:
+            # the images of the previous version are no longer needed
+            self.renderer.forget(previous)
+    
+    
+    def index_pages(self):
+        "Background thread: read the links and media of all pages"
+        for info in self.pages:
+            if self.closed:
+                break
+            if info is None:
+                continue
+            try:
+                if info.links is None:
+                    info.load_annotations()
+                info.get_hit_index()
+                for x,y,w,h, url, annot in info.get_media():
+                    if annot:
+                        self.media_manager.extract(annot)
+                if self.watch:
+                    # ready for the next version
+                    self.get_fingerprint(info, False)
+                    self.get_fingerprint(info, True)
+            except:
+                traceback.print_exc()
     
     def get_page_info(self, p,o):
         pass
 
 
-class OverlayInfo:
+def get_fingerprint(page):
+    "Identify the content of a poppler page: its size, text and a low resolution render"
+    digest = hashlib.sha1()
+    size = page.pageSize()
+    digest.update( (u"%s:%dx%d:%s" % (page.label(), size.width(), size.height(), page.text(QtCore.QRectF()))).encode("utf-8") )
+    image = page.renderToImage(FINGERPRINT_DPI, FINGERPRINT_DPI)
+    if not image.isNull():
+        digest.update( image.constBits().asstring(image.byteCount()) )
+    return digest.hexdigest()
+
+
+class OverlayInfo(object):
+    __slots__ = ("count", "pages")
+    
     def __init__(self,page):
         self.count = 0
         self.pages = []
@@ -99,18 +404,22 @@ class OverlayInfo:
         return self.pages[n]
 
 
-class PageInfo:
+class PageInfo(object):
     """Information about a specific page:
         * size
         * links
         * provides an image of the desired size
+    The poppler page itself is opened on demand.
     """
     
-    def __init__(self, doc, page, prev):
-        self.page = page
+    # many instances for large documents: keep them small
+    __slots__ = ("doc", "index", "label", "n", "o_n", "overlay", "prev", "next",
+                 "width", "height", "note_index", "links", "media", "videos", "hit_index", "transition")
+    
+    def __init__(self, doc, prev, index, label, width, height, transition):
         self.doc = doc
-        self.label = page.label()
-        self.cached = {}
+        self.index = index
+        self.label = label
         
         # no known successor yet
         self.next = None
@@ -136,38 +445,72 @@ class PageInfo:
             self.prev = prev.prev
         
         self.links = None
+        self.media = None
         self.videos = None
-        size = self.page.pageSize()
-        x,y,w,h = 0,0,  size.width(), size.height()
-        
-        self.note_box = None
-        self.note_page = None
+        self.hit_index = None
+        self.transition = transition
+        self.width = width
+        self.height = height
+        # index of a separate note page
+        self.note_index = None
+    
+    @property
+    def page(self):
+        return self.doc.get_page(self.index)
+    
+    @property
+    def note_page(self):
+        if self.note_index is None:
+            return None
+        return self.doc.get_page(self.note_index)
+    
+    @property
+    def bbox(self):
+        "Area of the slide in the page"
+        x,y,w,h = 0,0, self.width, self.height
+        doc = self.doc
         if doc.note_horizontal:
             w /= 2
             if doc.note_first:
                 x = w
-                self.note_box = (0,0,w,h)
-            else:
-                self.note_box = (w,0,w,h)
         elif doc.note_vertical:
             h /= 2
             if doc.note_first:
                 y = h
-                self.note_box = (0,0,w,h)
-            else:
-                self.note_box = (0,h,w,h)
-        self.bbox = (x,y,w,h)
-        self.has_note = self.note_box != None
+        return (x,y,w,h)
     
-    def set_note_page(self, page):
-        self.note_page = page
-        self.has_note = True
+    @property
+    def note_box(self):
+        "Area of the notes in the page (split pages only)"
+        x,y,w,h = 0,0, self.width, self.height
+        doc = self.doc
+        if doc.note_horizontal:
+            w /= 2
+            if not doc.note_first:
+                x = w
+        elif doc.note_vertical:
+            h /= 2
+            if not doc.note_first:
+                y = h
+        else:
+            return None
+        return (x,y,w,h)
     
-    def get_links(self):
-        if self.links is None:
-            # discover page links
-            self.links = []
-            for link in self.page.links():
+    @property
+    def has_note(self):
+        return self.note_index is not None or self.doc.note_horizontal or self.doc.note_vertical
+    
+    def read_annotations(self):
+        """Query poppler for the links and media of the page.
+        Returns the links, the media as (x,y,w,h, url, annotation),
+        and False if some link targets are not scanned yet.
+        """
+        links = []
+        media = []
+        complete = True
+        with self.doc.lock:
+            page = self.page
+            for link in page.links():
                 area = link.linkArea()
                 x = area.x()
                 y = area.y()
@@ -178,8 +521,12 @@ class PageInfo:
                     if p_idx < 0 or p_idx >= self.doc.lastPage:
                         print( "invalid link target: ", p_idx )
                         continue
-                    page = self.doc.pages[ p_idx ]
-                    self.links.append( Link(x,y,w,h, page) )
+                    if p_idx >= len(self.doc.pages):
+                        # target not scanned yet: try again later
+                        complete = False
+                        continue
+                    target = self.doc.pages[ p_idx ]
+                    links.append( Link(x,y,w,h, target) )
                 elif isinstance(link, popplerqt4.Poppler.LinkAction):
                     # TODO: action links (used by beamer)
                     pass
@@ -187,13 +534,8 @@ class PageInfo:
                     # other types of links to support?
                     print( type(link) )
                     pass
-        
-        return self.links
-    
-    def get_videos(self):
-        if self.videos is None:
-            self.videos = []
-            for annot in self.page.annotations():
+            
+            for annot in page.annotations():
                 if isinstance(annot, popplerqt4.Poppler.MovieAnnotation):
                     # movie annotation to a separate file (as added by beamer)
                     area = annot.boundary()
@@ -207,8 +549,7 @@ class PageInfo:
                     if not url.startswith( self.doc.basedir ):
                         print("External videos only accepted in current or sub folders")
                     else:
-                        media = gui.get_media_source(url,None)
-                        self.videos.append( (x,y,w,h, media) )
+                        media.append( (x,y,w,h, url, None) )
                 elif isinstance(annot, popplerqt4.Poppler.FileAttachmentAnnotation):
                     # Detect movies in file attachment annotations (inserted by movie15 in LaTeX)
                     area = annot.boundary()
@@ -219,12 +560,67 @@ class PageInfo:
                     annot.contents() # gives the MIME type: 'Media File (video/mp4)'
                     # TODO: how to check if it is indeed a playable video ?
                     if True:
-                        f = annot.embeddedFile() # gives the file itself
-                        media = gui.get_media_source(None,f)
-                        self.videos.append( (x,y,w,h, media) )
+                        # keep the annotation: it owns the embedded file
+                        media.append( (x,y,w,h, None, annot) )
+        
+        return links, media, complete
+    
+    def load_annotations(self):
+        "Read the links and media (done in the background by the document indexer)"
+        links, media, complete = self.read_annotations()
+        self.media = media
+        if complete:
+            self.links = links
+        return links
+    
+    def get_links(self):
+        if self.links is None:
+            return self.load_annotations()
+        return self.links
+    
+    def get_media(self):
+        if self.media is None:
+            self.load_annotations()
+        return self.media
+    
+    def get_videos(self):
+        if self.videos is None:
+            videos = []
+            for x,y,w,h, url, annot in self.get_media():
+                if url:
+                    media = gui.get_media_source(url)
+                else:
+                    # extracted in the background, loaded when played
+                    media = self.doc.media_manager.extract(annot)
+                videos.append( (x,y,w,h, media) )
+            self.videos = videos
         
         return self.videos
     
+    def get_transition(self):
+        """Transition defined by the PDF file to show this page:
+        (kind, duration in seconds, direction), the kind is None for a plain cut
+        """
+        # read by the loader with the other page properties
+        return self.transition
+    
+    def slide_area(self, x,y,w,h):
+        "Convert an area of the page (from 0 to 1) to an area of the slide"
+        bx,by,bw,bh = self.bbox
+        return ( (x*self.width - bx) / bw, (y*self.height - by) / bh,
+                 w*self.width / bw, h*self.height / bh )
+    
+    def get_hit_index(self):
+        """Spatial index of the links and videos of the slide.
+        While some link targets are not scanned yet, a partial index is kept
+        until the document scan completes.
+        """
+        if self.hit_index is None:
+            items = [ self.slide_area(l.x,l.y,l.w,l.h) + (l.page,) for l in self.get_links() ]
+            items.extend( self.slide_area(x,y,w,h) + ((url,annot),) for x,y,w,h, url,annot in self.get_media() )
+            self.hit_index = HitIndex(items)
+        return self.hit_index
+    
     def get_next_overlay(self):
         return self.overlay.get(self.o_n+1)
         
@@ -247,23 +643,70 @@ class PageInfo:
         return self.prev
     
     def get_image(self, width, height, note=False):
-        if width > 400:
+        if self.doc.renderer:
+            return self.doc.renderer.get_image(self, width, height, note)
+        key = (self, note, width, height)
+        image = self.doc.cache.get(key)
+        if image is None:
+            image = self.load_image(width, height, note)
+            self.doc.cache.add(key, image)
+        return image
+    
+    def load_image(self, width, height, note=False):
+        "Load an image from the disk cache or render it"
+        disk = self.doc.disk_cache
+        if not disk:
             return self.render_image(width, height, note)
-        size = (width,height)
-        if size not in self.cached:
-            self.cached[size] = self.render_image(width, height, note)
-        return self.cached[size]
+        
+        name = self.get_disk_name(width, height, note)
+        image = disk.get(name)
+        if image is None:
+            image = self.render_image(width, height, note)
+            disk.put(name, image)
+        return image
+    
+    def load_cached(self, width, height, note=False):
+        "Load an image from the disk cache, None rather than rendering it"
+        disk = self.doc.disk_cache
+        if not disk:
+            return None
+        return disk.get( self.get_disk_name(width, height, note) )
+    
+    def get_disk_name(self, width, height, note):
+        return "%d-%s-%s-%dx%d" % (self.index, self.doc.note_mode, note and "note" or "slide", width, height)
 
-    def render_image(self, width, height, note=False):
-        # TODO: cache image?
+    def get_preview(self, width, height, note=False):
+        """Get an image without waiting for a full render.
+        Returns the image and a flag set once it is the final one.
+        """
+        if self.doc.renderer:
+            return self.doc.renderer.get_preview(self, width, height, note)
+        return self.get_image(width, height, note), True
+    
+    def get_cached(self, width, height, note=False):
+        "The final image if it is ready, None rather than rendering it"
+        if self.doc.renderer:
+            return self.doc.renderer.peek(self, width, height, note)
+        return self.doc.cache.get( (self, note, width, height) )
+    
+    def get_thumbnail(self, width, height):
+        "Get a small image, scaled from the thumbnail atlas when possible"
+        if self.doc.renderer:
+            return self.doc.renderer.get_thumbnail(self, width, height)
+        return self.get_image(width, height), True
+    
+    def get_area(self, width, height, note=False):
+        """Find what to render for the slide (or its notes) to fit in the given size.
+        Returns the page index, DPI and area in pixels, None if there are no notes.
+        """
         # decide of DPI based on page and widget sizes
-        page = self.page
+        index = self.index
         if note:
-            if self.note_page:
-                page = self.note_page
+            if self.note_index is not None:
+                index = self.note_index
                 x,y,w,h = self.bbox
             elif not self.note_box:
-                return
+                return None
             else:
                 x,y,w,h = self.note_box
         else:
@@ -272,17 +715,53 @@ class PageInfo:
         wratio = float(width) / w
         hratio = float(height) / h
         scale = min(wratio, hratio)
-        dpi = 72 * scale
+        return index, 72*scale, x*scale, y*scale, w*scale, h*scale
+    
+    def render_image(self, width, height, note=False, antialias=True):
+        area = self.get_area(width, height, note)
+        if area is None:
+            return
+        index, dpi, x,y,w,h = area
+        scale = dpi / 72
+        note_box = self.note_box
         
-        x *= scale
-        y *= scale
-        w *= scale
-        h *= scale
+        if note_box and index == self.index:
+            # split page: render it once, slide and note are both areas of the same image
+            full = self.render_area(index, dpi, 0,0, self.width*scale, self.height*scale, antialias)
+            if not full or full.isNull():
+                return full
+            slide = render.SubImage(full, *[ v*scale for v in self.bbox ])
+            notes = render.SubImage(full, *[ v*scale for v in note_box ])
+            # keep the other half only if it is the image requested for that size
+            other = self.get_area(width, height, not note)
+            if other is not None and other[1] == dpi:
+                if note:
+                    self.doc.cache.add( (self, False, width, height), slide )
+                else:
+                    self.doc.cache.add( (self, True, width, height), notes )
+            return notes if note else slide
         
-        # render page as image
-        return page.renderToImage(dpi, dpi, x, y, w,h)
+        return self.render_area(index, dpi, x,y,w,h, antialias)
+    
+    @timing.timed("render")
+    def render_area(self, index, dpi, x,y,w,h, antialias=True):
+        "Render part of a page as image"
+        if self.doc.server:
+            image = self.doc.server.render(index, dpi, x, y, w,h, antialias)
+            if image is not None:
+                return image
+        with self.doc.lock:
+            if not antialias:
+                self.doc.set_antialias(False)
+            try:
+                return self.doc.get_page(index).renderToImage(dpi, dpi, x, y, w,h)
+            finally:
+                if not antialias:
+                    self.doc.set_antialias(True)
 
-class Link:
+class Link(object):
+    __slots__ = ("x", "y", "w", "h", "page")
+    
     def __init__(self, x,y,w,h, page):
         self.x = x
         self.y = y
@@ -297,3 +776,33 @@ class Link:
             self.y += h
             self.h = -h
 
+
+class HitIndex(object):
+    """Find the link or video under a point:
+        * areas in slide coordinates (from 0 to 1)
+        * sorted in the cells of a regular grid when building the index
+    """
+    __slots__ = ("size", "cells")
+    
+    def __init__(self, items, size=HIT_GRID):
+        self.size = size
+        self.cells = {}
+        for item in items:
+            x,y,w,h, target = item
+            for cx in self.get_range(x, w):
+                for cy in self.get_range(y, h):
+                    self.cells.setdefault( (cx,cy), [] ).append(item)
+    
+    def get_range(self, start, length):
+        first = max(0, int(start * self.size))
+        last = min(self.size-1, int((start+length) * self.size))
+        return range(first, last+1)
+    
+    def find(self, x, y):
+        "The target under a point of the slide, None if there is none"
+        if x < 0 or y < 0 or x >= 1 or y >= 1:
+            return None
+        for lx,ly,lw,lh, target in self.cells.get( (int(x*self.size), int(y*self.size)), () ):
+            if x > lx and x < lx+lw and y > ly and y < ly+lh:
+                return target
+        return None
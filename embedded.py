@@ -0,0 +1,189 @@
+import os
+import atexit
+import hashlib
+import binascii
+import threading
+import traceback
+import collections
+from PyQt4 import QtCore
+
+import render
+
+
+# keep extracted videos for the next sessions (in the XDG cache folder)
+KEEP_MEDIA = True
+
+# size limit of the kept videos (in bytes): the least recently used ones are removed
+MEDIA_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# size of the chunks written to disk (in bytes)
+CHUNK_SIZE = 1024 * 1024
+
+
+class MediaManager(QtCore.QObject):
+    """Extract embedded videos to files, as phonon can not play them from memory:
+        * in a background thread, written in chunks
+        * once per content, even if many slides use the same video
+        * a video about to be played goes first, its players are told when it is ready
+        * reused across sessions within a size limit, partial files are removed on exit
+    """
+
+    # emitted in the GUI thread with each finished extraction
+    extracted = QtCore.pyqtSignal(object)
+
+    def __init__(self, doc):
+        super(MediaManager, self).__init__()
+        self.doc = doc
+        self.folder = render.get_cache_folder("media")
+        self.lock = threading.Lock()
+        self.extractions = {}
+        self.created = []
+        # files used by this session, never evicted
+        self.used = set()
+
+        self.pending = collections.deque()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self.extract_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.cleanup)
+
+    def extract(self, annotation):
+        "Start the extraction of the file attached to an annotation, if needed"
+        with self.doc.lock:
+            embedded = annotation.embeddedFile()
+            name = str( embedded.name() )
+            size = embedded.size()
+            checksum = bytes( embedded.checksum() )
+
+        # identify the content by the checksum stored in the PDF when available,
+        # else by the PDF file and the name and size of the video, which survive a rebuild
+        if checksum:
+            key = binascii.hexlify(checksum).decode("ascii")
+        else:
+            identity = "%s:%s:%d" % (os.path.realpath(self.doc.filename), name, size)
+            key = hashlib.sha1( identity.encode("utf-8") ).hexdigest()
+        path = os.path.join(self.folder, key + os.path.splitext(name)[1])
+
+        with self.lock:
+            extraction = self.extractions.get(key)
+            if extraction:
+                return extraction
+            extraction = Extraction(path)
+            self.extractions[key] = extraction
+            self.used.add(path)
+
+        if os.path.isfile(path) and (size < 0 or os.path.getsize(path) == size):
+            # extracted in a previous session, remember the usage for the eviction
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            extraction.done(True)
+        else:
+            with self.lock:
+                self.pending.append( (key, extraction, annotation) )
+                self.wakeup.notify()
+        return extraction
+
+    def hurry(self, extraction):
+        "Extract a file before the others"
+        with self.lock:
+            for entry in self.pending:
+                if entry[1] is extraction:
+                    self.pending.remove(entry)
+                    self.pending.appendleft(entry)
+                    break
+
+    def extract_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.wakeup.wait()
+                key, extraction, annotation = self.pending.popleft()
+            try:
+                self.write(extraction.path, annotation)
+                extraction.done(True)
+            except:
+                traceback.print_exc()
+                # try again the next time the video is needed
+                with self.lock:
+                    self.extractions.pop(key, None)
+                extraction.done(False)
+            self.extracted.emit(extraction)
+
+    def write(self, path, annotation):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        tmp = path + ".part"
+        with self.lock:
+            self.created.append(tmp)
+        # poppler-qt4 has no stream access to embedded files, only the whole data at once:
+        # it is written in chunks and released as soon as it is written
+        with self.doc.lock:
+            data = annotation.embeddedFile().data()
+        with open(tmp, "wb") as f:
+            for offset in range(0, data.size(), CHUNK_SIZE):
+                f.write( bytes( data.mid(offset, CHUNK_SIZE) ) )
+        del data
+        os.rename(tmp, path)
+        with self.lock:
+            self.created.append(path)
+        if KEEP_MEDIA:
+            self.evict()
+
+    def evict(self):
+        "Remove the least recently used videos above the size limit, except the ones of this session"
+        files = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append( (st.st_mtime, st.st_size, path) )
+        files.sort()
+        total = sum( size for mtime, size, path in files )
+        with self.lock:
+            used = set(self.used)
+        for mtime, size, path in files:
+            if total <= MEDIA_CACHE_SIZE:
+                break
+            if path in used or path.endswith(".part"):
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def cleanup(self):
+        "Remove partial files, and the extracted ones unless they are kept"
+        with self.lock:
+            for path in self.created:
+                if KEEP_MEDIA and not path.endswith(".part"):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class Extraction:
+    "Path of an extracted file, usable once the extraction is done"
+
+    def __init__(self, path):
+        self.path = path
+        self.ready = threading.Event()
+        self.ok = False
+
+    def done(self, ok):
+        self.ok = ok
+        self.ready.set()
+
+    def wait(self, timeout=None):
+        "Wait for the extraction, return the path or None if it failed"
+        self.ready.wait(timeout)
+        if self.ok:
+            return self.path
+        return None
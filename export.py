@@ -0,0 +1,150 @@
+#! /usr/bin/python
+
+import os, sys
+import time
+import argparse
+import traceback
+import multiprocessing
+
+
+# size of the exported images when none is given
+SIZES = ( (1920,1080), )
+
+# image format of the exported files
+FORMAT = "png"
+
+
+def get_jobs(doc, args):
+    "List the images to render as (page index, dpi, x,y,w,h, path)"
+    slides = []
+    for info in doc.layout:
+        if args.overlays:
+            slides.extend( (info, "slide-%03d-%02d" % (info.n+1, page.o_n+1), page) for page in info.overlay.pages )
+        else:
+            # the complete slide: its last overlay
+            slides.append( (info, "slide-%03d" % (info.n+1), info.overlay.pages[-1]) )
+
+    outputs = [ ("%dx%d" % size, size, False) for size in args.sizes ]
+    if args.notes:
+        outputs.extend( ("%dx%d" % size, size, True) for size in args.sizes )
+    if args.thumbnails:
+        import render
+        outputs.append( ("thumbnails", (render.THUMB_WIDTH, render.THUMB_HEIGHT), False) )
+
+    jobs = []
+    for folder, (width, height), note in outputs:
+        folder = os.path.join(args.output, folder)
+        for info, name, page in slides:
+            if note:
+                if not page.has_note:
+                    continue
+                name = name.replace("slide", "notes", 1)
+            area = page.get_area(width, height, note)
+            if area is None:
+                continue
+            index, dpi, x,y,w,h = area
+            path = os.path.join(folder, "%s.%s" % (name, args.format))
+            jobs.append( (index, dpi, int(round(x)), int(round(y)), int(round(w)), int(round(h)), path) )
+    return jobs
+
+
+# poppler document of each worker process
+document = None
+
+def init_worker(filename):
+    global document
+    import popplerqt4
+    document = popplerqt4.Poppler.Document.load(filename)
+    document.setRenderHint(popplerqt4.Poppler.Document.TextAntialiasing, True)
+    document.setRenderHint(popplerqt4.Poppler.Document.Antialiasing, True)
+
+def export_image(job):
+    "Render and save an image in a worker process, return its path and the time spent (None on failure)"
+    index, dpi, x,y,w,h, path = job
+    start = time.time()
+    try:
+        image = document.page(index).renderToImage(dpi, dpi, x,y,w,h)
+        if image.isNull() or not image.save(path):
+            return path, None
+    except:
+        traceback.print_exc()
+        return path, None
+    return path, time.time() - start
+
+
+def export(filename, args):
+    from doc import Document
+    start = time.time()
+    # the pool below does the rendering, nothing else is needed
+    doc = Document(filename, in_process=True, interactive=False)
+    doc.scan(None, True)
+
+    jobs = get_jobs(doc, args)
+    for folder in set( os.path.dirname(job[-1]) for job in jobs ):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    # Qt does not like to be forked: start fresh processes when possible
+    if hasattr(multiprocessing, "get_context"):
+        ctx = multiprocessing.get_context("spawn")
+    else:
+        ctx = multiprocessing
+    pool = ctx.Pool(args.processes, init_worker, (filename,))
+
+    done = 0
+    failed = 0
+    render_time = 0
+    written = 0
+    try:
+        for path, duration in pool.imap_unordered(export_image, jobs):
+            done += 1
+            if duration is None:
+                failed += 1
+                sys.stdout.write( "\nFailed to export %s\n" % path )
+            else:
+                render_time += duration
+                written += os.path.getsize(path)
+            sys.stdout.write( "\r%d/%d images" % (done, len(jobs)) )
+            sys.stdout.flush()
+    finally:
+        pool.terminate()
+        doc.close()
+
+    elapsed = time.time() - start
+    print( "" )
+    print( "%d images (%d failed) in %.1f s: %.1f images/s, %.1f ms per image in %d processes, %.1f MB" % (
+        done, failed, elapsed, done / max(elapsed, 0.001), 1000 * render_time / max(done-failed, 1),
+        args.processes, written / (1024.0*1024) ) )
+    return failed == 0
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Render the slides of a PDF file to images, with pdfpc's overlay and note detection")
+    parser.add_argument("file", help="PDF file to export")
+    parser.add_argument("-o", "--output", help="target folder (next to the PDF file by default)")
+    parser.add_argument("--size", dest="sizes", action="append", type=parse_size, help="image size (WxH), can be repeated")
+    parser.add_argument("--overlays", action="store_true", help="export every overlay, not only complete slides")
+    parser.add_argument("--notes", action="store_true", help="also export the note pages")
+    parser.add_argument("--thumbnails", action="store_true", help="also export thumbnails")
+    parser.add_argument("--format", default=FORMAT, help="image format (png, jpg...)")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="number of render processes")
+    args = parser.parse_args(argv)
+    if not args.sizes:
+        args.sizes = SIZES
+    if not args.output:
+        args.output = os.path.splitext(args.file)[0] + "-export"
+    args.processes = max(1, args.processes)
+
+    if not os.path.isfile(args.file):
+        print( args.file+" is not a file" )
+        return False
+    return export(args.file, args)
+
+
+if __name__ == "__main__":
+    sys.exit( 0 if main(sys.argv[1:]) else 1 )
@@ -4,10 +4,9 @@ import time
 import traceback
 from PyQt4 import QtGui, QtCore
 from PyQt4.phonon import Phonon
+import timing
 
 
-COPY_EMBEDDED_VIDEO = True
-
 # fancy HSV color setup: change the HUE to change the theme
 RED,BROWN,GREEN,BLUE = 0,40,120,240
 HUE = BLUE
@@ -37,27 +36,90 @@ LINK = QtGui.QColor(200, 50, 50, 50)
 
 FROZEN = "F"
 
+# number of idle video players kept for reuse
+PLAYER_POOL = 4
+
+# minimal delay between two repaints (ms)
+FRAME_INTERVAL = 16
+
+# size of the grid of search results
+SEARCH_COLUMNS = 4
+SEARCH_ROWS = 3
+
+# maximal number of columns in the overview, and share of the distance scrolled per frame
+OVERVIEW_COLUMNS = 6
+SCROLL_SPEED = 0.35
+
+# transition to the next slide on the audience view when the PDF file has none:
+# None (cut), "fade", "push" or "wipe", and its duration (s)
+TRANSITION = None
+TRANSITION_DURATION = 0.4
+
+# time budget of a transition frame (ms): late frames are dropped,
+# the transition is cut short after this many late frames
+FRAME_BUDGET = 12
+LATE_FRAMES = 3
+
 
 class StatusBar(QtGui.QWidget):
     "The bottom bar of the presenter console: shows a timer and status icons"
     def __init__(self, app, view):
         self.app = app
         super(StatusBar, self).__init__(view)
+        # woken up when the displayed second changes, not polling
         self._timer = QtCore.QTimer()
-        self._timer.timeout.connect(self.refresh)
-        self._timer.start(500)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.tick)
         self.h_icon = None
+        self.layer = None
+        self.layer_state = None
+        self.timetext = None
+    
+    def get_state(self):
+        "Everything shown in the static layer: background, progress and icons"
+        seconds,paused = self.app.get_clock()
+        return (self.size(), self.app.get_current().n, len(self.app.doc.layout),
+                self.app.color, self.app.freezed, paused)
+    
+    def get_timetext(self):
+        if self.app.jump_text is not None:
+            return self.app.get_jump_text()
+        seconds,paused = self.app.get_clock()
+        minutes = seconds / 60
+        seconds %= 60
+        hours = minutes / 60
+        minutes %= 60
+        return "%02d:%02d:%02d" % (hours,minutes,seconds)
     
     def refresh(self):
-        self.update()
+        if self.get_state() != self.layer_state:
+            self.app.schedule(self)
+        self.tick()
     
-    def paintEvent(self, e):
+    def tick(self):
+        "Only repaint the timer, when the displayed time changes"
+        if self.get_timetext() != self.timetext:
+            size = self.size()
+            width = size.width()
+            height = size.height()
+            self.app.schedule(self, QtCore.QRect(int(width/4), 0, int(width/2), height))
+        
+        start = self.app.clock_start
+        if start is None:
+            self._timer.stop()
+        else:
+            self._timer.start( int(1000 * (1 - (time.time() - start) % 1)) + 1 )
+    
+    def resizeEvent(self, evt):
+        self.layer = None
+    
+    def paint_layer(self, state):
+        "Draw the parts of the bar which do not change every second"
         size = self.size()
         width = w = size.width()
         height = h = size.height()
         margin = h/8
         h_icon = 6*h/8
-        timer_w = 4*h_icon
         if h_icon != self.h_icon:
             self.h_icon = h_icon
             # detect DPI to select the proper font size
@@ -65,25 +127,16 @@ class StatusBar(QtGui.QWidget):
             font_size = h_icon - 2*margin
             self.font = QtGui.QFont('Sans', font_size/font_scale)
         
+        layer = QtGui.QPixmap(size)
         qp = QtGui.QPainter()
-        qp.begin(self)
+        qp.begin(layer)
         
         qp.setBrush(HELP_BG)
         qp.setPen(HELP_BG)
         qp.drawRect(0,0,w,h)
         show_progress(qp, 0, h-margin, w,margin, self.app.get_current().n+1, len(self.app.doc.layout))
-        
-        qp.setPen(TEXT)
         qp.setFont(self.font)
-        seconds,paused = self.app.get_clock()
-        minutes = seconds / 60
-        seconds %= 60
-        hours = minutes / 60
-        minutes %= 60
-        timetext = "%02d:%02d:%02d" % (hours,minutes,seconds)
-        qp.drawText(0,0,w,h, QtCore.Qt.AlignCenter, timetext)
         
-
         x = margin - height
         y = margin/2
         m = h_icon/8
@@ -104,6 +157,7 @@ class StatusBar(QtGui.QWidget):
             qp.setPen(COLD)
             qp.drawText(x+m,y+m,w-2*m,h-2*m, QtCore.Qt.AlignCenter, FROZEN)
         
+        paused = state[-1]
         if paused:
             x = width - height
             qp.setBrush(ICON)
@@ -116,32 +170,90 @@ class StatusBar(QtGui.QWidget):
             qp.drawRect(x+w/2+dx, y+w/5, bw, bh)
         
         qp.end()
+        return layer
+    
+    @timing.painted("status")
+    def paintEvent(self, e):
+        size = self.size()
+        w = size.width()
+        h = size.height()
+        
+        state = self.get_state()
+        if self.layer is None or state != self.layer_state:
+            self.layer = self.paint_layer(state)
+            self.layer_state = state
+        
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        qp.drawPixmap(0,0, self.layer)
+        
+        qp.setPen(TEXT)
+        qp.setFont(self.font)
+        self.timetext = self.get_timetext()
+        qp.drawText(0,0,w,h, QtCore.Qt.AlignCenter, self.timetext)
+        
+        qp.end()
 
 class SlideView(QtGui.QWidget):
     def __init__(self, app, view):
         self.app = app
+        self.view = view
         self.info = None
         self.image = None
+        self.final = True
+        self.area = None
+        self.color = None
         self.baits = []
+        self.transition = None
         super(SlideView, self).__init__(view)
+        self.setMouseTracking(True)
     
     def set_slide(self, info):
-        if self.info != info:
+        if self.info != info or self.color != self.app.color:
+            self.transition = None
+            if info and self.info and self.image and self.final and not self.color and not self.app.color:
+                self.start_transition(info)
             self.info = info
+            self.color = self.app.color
             self.image = None
         
         if not self.image:
-            self.update()
+            self.app.schedule(self)
+    
+    def start_transition(self, info):
+        """Animate the change to a slide on the audience view, only when its final image
+        is already rendered: the frames are composited from the two cached images
+        """
+        if self.view.presenter_mode:
+            return
+        kind, duration, direction = info.get_transition()
+        if not kind:
+            kind = TRANSITION
+            duration = TRANSITION_DURATION
+        if not kind or duration <= 0:
+            return
+        size = self.size()
+        target = info.get_cached(size.width(), size.height())
+        if target is not None:
+            self.transition = Transition(kind, duration, direction, self.image, target)
     
     def resizeEvent(self, evt):
+        self.transition = None
         self.image = None
     
+    def rendered(self, info):
+        "Replace the preview when the final image is ready"
+        if not self.final and info is self.info:
+            self.image = None
+            self.app.schedule(self)
+    
+    @timing.painted("slide")
     def paintEvent(self, e):
         size = self.size()
         width =  size.width()
         height = size.height()
         
-        # clear old links
+        # clear old videos
         if not self.image or self.app.color:
             for bait in self.baits:
                 bait.clear()
@@ -155,24 +267,18 @@ class SlideView(QtGui.QWidget):
             qp.setBrush(self.app.color)
             qp.drawRect(0, 0, width, height)
         elif self.info:
-            if not self.image:
-                self.image = self.info.get_image(width,height)
-                ix,iy,iw,ih = paint_image(qp, self.image, 0,0,width,height)
-            
-                # add links
-                for l in self.info.get_links():
-                    ax = ix + iw * l.x
-                    ay = iy + ih * l.y
-                    aw = iw * l.w
-                    ah = ih * l.h
-                    bait = LinkBox(self, l.page, ax,ay,aw,ah)
-                    self.baits.append( bait )
+            if self.transition and self.paint_transition(qp, width, height):
+                pass
+            elif not self.image:
+                self.image, self.final = self.info.get_preview(width,height)
+                self.area = ix,iy,iw,ih = paint_image(qp, self.image, 0,0,width,height)
                 
                 # add videos
                 for vx,vy,vw,vh,media in self.info.get_videos():
                     if not media:
                         continue
                     
+                    vx,vy,vw,vh = self.info.slide_area(vx,vy,vw,vh)
                     ax = ix + iw * vx
                     ay = iy + ih * vy
                     aw = iw * vw
@@ -184,6 +290,59 @@ class SlideView(QtGui.QWidget):
             
         qp.end()
     
+    def paint_transition(self, qp, width, height):
+        "Paint a frame of the transition, False once it is over"
+        transition = self.transition
+        start = timing.clock()
+        # the progress follows the clock: frames that came late are skipped
+        progress = transition.get_progress()
+        self.area = None
+        if progress >= 1:
+            self.transition = None
+            return False
+        
+        qp.fillRect(0, 0, width, height, BG)
+        if transition.kind == "fade":
+            paint_image(qp, transition.source, 0,0,width,height)
+            qp.setOpacity(progress)
+            paint_image(qp, transition.target, 0,0,width,height)
+            qp.setOpacity(1)
+        elif transition.kind == "push":
+            dx = int(width * progress) * transition.direction
+            paint_image(qp, transition.source, -dx,0,width,height)
+            paint_image(qp, transition.target, width*transition.direction - dx,0,width,height)
+        else:
+            paint_image(qp, transition.source, 0,0,width,height)
+            w = int(width * progress)
+            x = 0 if transition.direction < 0 else width - w
+            qp.setClipRect(x, 0, w, height)
+            paint_image(qp, transition.target, 0,0,width,height)
+            qp.setClipping(False)
+        
+        end = timing.clock()
+        if timing.ENABLED:
+            timing.record("transition", start, end)
+        if (end - start) * 1000 > FRAME_BUDGET:
+            transition.late += 1
+            if transition.late >= LATE_FRAMES:
+                # too slow for this screen: cut to the slide on the next frame
+                self.transition = None
+        self.app.schedule(self)
+        return True
+    
+    def find_target(self, pos):
+        "The link or video under a position of the widget"
+        if not self.info or not self.area or self.app.color:
+            return None
+        ix,iy,iw,ih = self.area
+        return self.info.get_hit_index().find( float(pos.x()-ix) / iw, float(pos.y()-iy) / ih )
+    
+    def mouseMoveEvent(self, evt):
+        self.app.has_moved( self.find_target(evt.pos()) )
+    
+    def mouseReleaseEvent(self, evt):
+        self.app.click_map( self.find_target(evt.pos()) )
+    
     def video(self, loop=False):
         for bait in self.baits:
             if isinstance(bait,VideoBox):
@@ -197,8 +356,28 @@ class SlideView(QtGui.QWidget):
         return found
 
 
+class Transition:
+    "Images and progress of a transition between two slides"
+    
+    def __init__(self, kind, duration, direction, source, target):
+        self.kind = kind
+        self.duration = duration
+        self.direction = direction
+        self.source = source
+        self.target = target
+        self.late = 0
+        self.start = None
+    
+    def get_progress(self):
+        "Share of the transition done, from the first painted frame"
+        now = time.time()
+        if self.start is None:
+            self.start = now
+        return (now - self.start) / self.duration
+
+
 class ClickBait(QtGui.QWidget):
-    "Base class for links and videos: take up the reserved space and detect clicks"
+    "Base class for videos: take up the reserved space and detect clicks"
     
     def __init__(self, view, x,y,w,h):
         super(ClickBait, self).__init__(view)
@@ -217,57 +396,76 @@ class ClickBait(QtGui.QWidget):
         self.activate()
 
 
-class LinkBox(ClickBait):
-    "PDF links: jump to another page on the same document"
-    def __init__(self, view, target, x,y,w,h):
-        super(LinkBox, self).__init__(view, x,y, w,h)
-        self.app = view.app
-        self.target = target
-    
-    def activate(self):
-        self.app.set_current(self.target)
-
-
 class SideBar(QtGui.QWidget):
     def __init__(self, app, view):
         self.app = app
+        self.shown = None
+        self.images = None
+        self.final = True
         super(SideBar, self).__init__(view)
     
     def refresh(self):
-        self.update()
+        if self.shown is not self.app.get_current():
+            self.app.schedule(self)
     
-    def paintEvent(self, e):
+    def resizeEvent(self, evt):
+        self.images = None
+    
+    def rendered(self, info):
+        if self.final:
+            return
+        for t_info, x,y,w,h, note in self.get_targets(self.app.get_current()):
+            if info is t_info:
+                self.app.schedule(self)
+    
+    def get_targets(self, info):
+        "List the (page, x,y,w,h, note) shown in the side bar when the given page is current"
         size = self.size()
         width =  size.width()
         height = size.height()
         margin = width/20
         
         x = margin/2
-        y = x
         w = width - 2*margin
         h = (height-margin)/2
         
-        info = self.app.get_current()
-        
-        
-        qp = QtGui.QPainter()
-        qp.begin(self)
-        
         # notes / overlay
         if info.has_note:
-            note=True
             o_info = info
+            note = True
         else:
-            o_info = self.app.get_next_overlay()
-            note=False
-        if o_info:
-            place_image(qp, o_info, x,0,w,h, note=note, align=1)
+            o_info = info.get_next_overlay()
+            note = False
         
         # next
-        y += h
-        n_info = self.app.get_next()
-        if n_info:
-            place_image(qp, n_info, x,h+margin,w,h, align=1)
+        n_info = info.next
+        return ( (o_info, x,0,w,h, note), (n_info, x,h+margin,w,h, False) )
+    
+    @timing.painted("sidebar")
+    def paintEvent(self, e):
+        size = self.size()
+        width =  size.width()
+        height = size.height()
+        margin = width/20
+        
+        info = self.app.get_current()
+        
+        # only request the images again for a new slide or to replace previews
+        if info is not self.shown or not self.final or self.images is None:
+            self.shown = info
+            self.final = True
+            self.images = []
+            for t_info, x,y,w,h, note in self.get_targets(info):
+                if t_info:
+                    image, final = t_info.get_preview(w,h, note)
+                    self.final = self.final and final
+                    self.images.append( (image, x,y,w,h) )
+        
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        
+        for image, x,y,w,h in self.images:
+            paint_image(qp, image, x,y,w,h, align=1)
         
         
         # progressbar for the current overlay
@@ -279,236 +477,402 @@ class SideBar(QtGui.QWidget):
 
 
 class Overview(QtGui.QWidget):
+    """Grid of all the slides, scrolled smoothly to follow the selection:
+        * only the visible cells are painted
+        * the images of the cells are kept while they stay visible
+        * thumbnails are rendered around the selection first
+    """
+    
     def __init__(self, app, view):
         self.app = app
         self.doc = app.doc
-        # pick settings for the overview
-        self.n = n = len(self.doc.layout)
+        self.n = None
+        self.geometry = None
+        self.cells = {}
+        self.selected = None
+        self.offset = 0
+        self.target = 0
+        
+        super(Overview, self).__init__(view)
+        self.setCursor( QtGui.QCursor(QtCore.Qt.PointingHandCursor) )
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self.scroll_step)
+    
+    def configure(self):
+        "pick settings for the overview (the number of slides grows while scanning)"
+        n = len(self.doc.layout)
+        size = self.size()
+        geometry = (n, size.width(), size.height())
+        if geometry == self.geometry:
+            return
+        self.geometry = geometry
+        self.n = n
         onx = 3
         ony = 2
-        while n > onx*ony:
+        while n > onx*ony and onx < OVERVIEW_COLUMNS:
             if ony < onx:
                 ony += 1
             else:
                 onx += 1
-            if onx > 6:
-                break
         self.onx = onx
         self.ony = ony
-        self.nthumbs = onx * ony
-        self.npages = math.ceil(n / self.nthumbs)
-
-        self.thumbs = []
-        self.selected = None
-        self.start = 0
+        self.rows = int(math.ceil( float(n) / onx ))
         
-        super(Overview, self).__init__(view)
+        m = self.margin = 10
+        self.dx = max(m+1, (size.width() - m) / onx)
+        self.dy = max(m+1, (size.height() - m) / ony)
+        self.max_offset = max(0, self.rows*self.dy - (size.height() - m))
+        self.offset = min(self.offset, self.max_offset)
+        self.target = min(self.target, self.max_offset)
+        # new grid (or new document): repaint all the cells
+        self.cells = {}
+        self.app.schedule(self)
     
-    def clear(self):
-        for t in self.thumbs:
-            t.clear()
+    def resizeEvent(self, evt):
+        self.configure()
+    
+    def get_cell(self, i):
+        "Geometry (x,y,w,h) of the cell of the i-th slide"
+        row, col = divmod(i, self.onx)
+        m = self.margin
+        return (int(m + col*self.dx), int(m + row*self.dy - self.offset), int(self.dx - m), int(self.dy - m))
+    
+    def get_visible(self, extra=0):
+        "Range of the slides shown, with a few extra rows around"
+        first = max(0, int(self.offset / self.dy) - extra)
+        last = int( (self.offset + self.height()) / self.dy ) + 1 + extra
+        return range(first*self.onx, min(self.n, last*self.onx))
+    
+    def find_slide(self, x, y):
+        "Index of the slide under the given point"
+        col = int( (x - self.margin/2) / self.dx )
+        row = int( (y - self.margin/2 + self.offset) / self.dy )
+        i = row * self.onx + col
+        if col < self.onx and 0 <= i < self.n:
+            return i
+        return None
+    
+    def rendered(self, info):
+        cell = self.cells.get(info.n)
+        if cell and not cell[1]:
+            del self.cells[info.n]
+            if self.isVisible():
+                self.app.schedule(self, QtCore.QRect(*self.get_cell(info.n)))
+    
+    def scroll_to(self, offset, smooth=True):
+        self.target = max(0, min(offset, self.max_offset))
+        if not smooth:
+            self.offset = self.target
+            self.app.schedule(self)
+        elif not self._timer.isActive():
+            self._timer.start(FRAME_INTERVAL)
+    
+    def scroll_step(self):
+        "Move part of the way to the target offset, once per frame"
+        delta = self.target - self.offset
+        if abs(delta) < 1:
+            self.offset = self.target
+            self._timer.stop()
+            # prepare the slides where the scrolling stopped
+            self.app.prefetch()
+        else:
+            self.offset += delta * SCROLL_SPEED
+        self.app.schedule(self)
+    
+    def show_selection(self, smooth=True):
+        "Scroll just enough to show the selected slide"
+        top = (self.selected // self.onx) * self.dy
+        visible = self.height() - self.margin
+        if top < self.target:
+            self.scroll_to(top, smooth)
+        elif top + self.dy > self.target + visible:
+            self.scroll_to(top + self.dy - visible, smooth)
     
-    def move_selection(self, m):
-        if self.selected is None:
+    def refresh(self):
+        self.configure()
+        selected = self.app.get_current_overview().overlay.pages[0].n
+        if selected == self.selected:
             return
         
-        newsel = self.selected + m
-        if newsel < 0:
-            newsel = 0
-        elif self.selected >= self.n:
-            new = self.n-1
-        
-        if newsel != self.selected:
-            self.thumbs[self.selected].select(False)
-            self.thumbs[newsel].select()
-            self.selected = newsel
+        if self.selected is not None and self.selected < self.n:
+            self.app.schedule(self, QtCore.QRect(*self.get_cell(self.selected)))
+        self.selected = selected
+        self.app.schedule(self, QtCore.QRect(*self.get_cell(selected)))
+        self.show_selection(self.isVisible())
+        self.app.renderer.atlas.focus(selected)
     
-    def next(self):
-        self.move_selection(1)
+    def get_prefetch(self):
+        "List the thumbnails around the visible ones, closest to the selection first"
+        self.configure()
+        selected = self.app.get_current_overview().overlay.pages[0].n
+        slides = sorted( self.get_visible(1), key=lambda i: abs(i - selected) )
+        w = int(self.dx) - self.margin - 10
+        h = int(self.dy) - self.margin - 10
+        return [ (self.doc.layout[i], w, h, False) for i in slides ]
     
-    def prev(self):
-        self.move_selection(-1)
+    def wheelEvent(self, evt):
+        self.scroll_to(self.target - evt.delta() * self.dy / 240)
     
-    def refresh(self):
-        # TODO: multipage overview
-        #  * shift starting point
-        #  * show page indicators
+    def mouseReleaseEvent(self, evt):
+        i = self.find_slide(evt.x(), evt.y())
+        if i is not None:
+            self.app.set_current_overview(self.doc.layout[i], True)
+    
+    @timing.painted("overview")
+    def paintEvent(self, e):
+        current = self.app.get_current().overlay.pages[0].n
+        visible = self.get_visible()
+        
+        # recycle the images of the cells still visible
+        cells = {}
+        for i in visible:
+            cell = self.cells.get(i)
+            if cell is None:
+                x,y,w,h = self.get_cell(i)
+                cell = self.doc.layout[i].get_thumbnail(w-10, h-10)
+            cells[i] = cell
+        self.cells = cells
+        
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        qp.fillRect(e.rect(), BLACK)
         
-        self.clear()
+        for i in visible:
+            x,y,w,h = self.get_cell(i)
+            if i == self.selected:
+                qp.setBrush(SEL2)
+            elif i == current:
+                qp.setBrush(SEL)
+            else:
+                qp.setBrush(ICON)
+            qp.drawRect(x,y, w,h)
+            paint_image(qp, cells[i][0], x,y,w,h)
         
+        # position in the whole deck
+        if self.max_offset > 0:
+            height = self.height()
+            bar = max(self.margin, height * height / (height + self.max_offset))
+            qp.setBrush(ICON)
+            qp.setPen(ICON)
+            qp.drawRect(self.width() - self.margin/2, int( (height - bar) * self.offset / self.max_offset ), self.margin/4, int(bar))
+        qp.end()
+
+
+class HelpBox(QtGui.QWidget):
+    def __init__(self, app, view):
+        self.app = app
+        super(HelpBox, self).__init__(view)
+    
+    def paintEvent(self, e):
         size = self.size()
         width =  size.width()
         height = size.height()
-        m = margin = 10
+        margin = min(width,height) / 20
         
-        x = y = margin/2
-        w = width - margin
-        h = height - margin
+        help, n,l = self.app.get_help()
         
+        qp = QtGui.QPainter()
+        qp.begin(self)
         
-        n = len(self.doc.layout)
+        qp.setBrush(HELP_BG)
+        qp.setPen(WHITE)
+        qp.drawRect(0,0, width,height)
         
-        dx = w / self.onx
-        mw = dx-m
-        
-        dy = h/self.ony
-        mh = dy-m
-        
-        mm = m/2
-        cury = y+mm
-        self.link_map = []
-        current = self.app.get_current().overlay.pages[0]
-        current_o = self.app.get_current_overview().overlay.pages[0]
-        # find the starting page
-        self.start = 0
-        nthumbs = self.nthumbs - 2
-        if n > self.nthumbs and current_o.n > nthumbs:
-            skipped = int(math.floor( (current_o.n - 1) / nthumbs ))
-            self.start = nthumbs * skipped + 1
-        i = self.start
-        for line in range(self.ony):
-            curx = x+mm
-            for col in range(self.onx):
-                if i >= n:
-                    break
-                if self.start > 0 and line == 0 and col == 0:
-                    # Link to the previous page
-                    info = self.doc.layout[i-1]
-                    box = PrevNextBox(self, info, curx,cury,mw,mh, True)
-                    self.thumbs.append(box)
-                elif line == self.ony-1 and col == self.onx-1 and i < n:
-                    # Link to the next page
-                    info = self.doc.layout[i]
-                    box = PrevNextBox(self, info, curx,cury,mw,mh, False)
-                    self.thumbs.append(box)
-                else:
-                    info = self.doc.layout[i]
-                    is_current = info==current
-                    is_selected = info==current_o
-                    box = ThumbBox(self, info, is_current, is_selected, curx,cury,mw,mh)
-                    self.thumbs.append(box)
-                    i += 1
-                curx += dx
-            cury += dy
-
-class ThumbBox(ClickBait):
-    "Thumbnail in the overview"
-    
-    def __init__(self, view, target, is_current, is_selected, x,y,w,h):
-        super(ThumbBox, self).__init__(view, x,y, w,h)
-        self.app = view.app
-        self.target = target
-        self.is_current = is_current
-        self.is_selected = is_selected
-        self.image = None
+        # pick font size
+        dpi = QtGui.QDesktopWidget().physicalDpiX()
+        font_scale = dpi / 96
+        font_size = min(width/(l+4), height/(n+8)) / font_scale
+        help_font = QtGui.QFont('Mono', font_size)
+        
+        qp.setFont(help_font)
+        qp.drawText(margin,margin,width-2*margin,height-2*margin,
+             QtCore.Qt.AlignLeft, help)
+        
+        qp.end()
+
+class JumpBox(QtGui.QWidget):
+    "The slide number or label being typed, when the status bar is hidden"
     
-    def select(self, s=True):
-        self.is_selected = s
-        self.update()
+    def __init__(self, app, view):
+        self.app = app
+        super(JumpBox, self).__init__(view)
     
-    def resizeEvent(self, evt):
-        self.image = None
+    def refresh(self):
+        self.app.schedule(self)
     
-    def activate(self):
-        self.app.set_current_overview(self.target, True)
-
-    def paintEvent(self, evt):
+    def paintEvent(self, e):
         size = self.size()
         width =  size.width()
         height = size.height()
-
-        if not self.image:
-            self.image = self.target.get_image(width-10, height-10)
-
+        
         qp = QtGui.QPainter()
         qp.begin(self)
-
-        if self.is_selected:
-            qp.setBrush(SEL2)
-        elif self.is_current:
-            qp.setBrush(SEL)
-        else:
-            qp.setBrush(ICON)
-
-        qp.drawRect(0,0, width,height)
-        paint_image(qp, self.image, 0,0,width,height)
+        qp.setBrush(HELP_BG)
+        qp.setPen(ICON)
+        qp.drawRect(0,0, width-1,height-1)
+        font_scale = QtGui.QDesktopWidget().physicalDpiX() / 96
+        qp.setFont( QtGui.QFont('Sans', int(height / 3 / font_scale)) )
+        qp.setPen(TEXT)
+        qp.drawText(0,0, width,height, QtCore.Qt.AlignCenter, self.app.get_jump_text() or "")
         qp.end()
 
-class PrevNextBox(ClickBait):
-    "Prev/Next page in the overview"
-
-    def __init__(self, view, target, x,y,w,h, is_prev):
-        super(PrevNextBox, self).__init__(view, x,y, w,h)
-        self.view = view
-        self.target = target
-        self.is_selected = False
-        self.is_prev = is_prev
-
-    def select(self, s=True):
-        self.is_selected = s
-        self.update()
-
-    def activate(self):
-        self.view.app.set_current_overview(self.target)
-
-    def paintEvent(self, evt):
+class SearchBox(QtGui.QWidget):
+    "Type-ahead search: the query and the matching slides"
+    
+    def __init__(self, app, view):
+        self.app = app
+        super(SearchBox, self).__init__(view)
+    
+    def refresh(self):
+        self.app.schedule(self)
+    
+    def rendered(self, info):
+        if info in self.app.search_results:
+            self.app.schedule(self)
+    
+    @timing.painted("search")
+    def paintEvent(self, e):
         size = self.size()
         width =  size.width()
         height = size.height()
-
+        margin = min(width,height) / 20
+        
         qp = QtGui.QPainter()
         qp.begin(self)
-
-        qp.setBrush(WHITE)
-
-        # TODO: draw some arrow thingie
-        qp.drawRect(10, height/2 - 5, width - 20, 10)
-        if self.is_prev:
-            px  = int(2*width/3)
-            pxx = width - 10
+        
+        qp.setBrush(HELP_BG)
+        qp.setPen(HELP_BG)
+        qp.drawRect(0,0, width,height)
+        
+        # query and status on the first line
+        line_h = height / 12
+        font_scale = QtGui.QDesktopWidget().physicalDpiX() / 96
+        qp.setFont( QtGui.QFont('Sans', line_h / 2 / font_scale) )
+        qp.setPen(TEXT)
+        index = self.app.doc.text_index
+        results = self.app.search_results
+        if not index.complete:
+            status = "indexing %d/%d pages" % (index.indexed, index.total or len(self.app.doc.pages))
         else:
-            px = int(width/3)
-            pxx = width + 10
-        y_up = int(height/3)
-        y_down = int(2*height/3)
-        y_mid = int(height/2)
-        arrow = QtGui.QPolygon( (px,y_up, pxx,y_mid, px,y_down) )
-        qp.drawPolygon( arrow )
+            status = "%d slides" % self.app.search_count
+            shown = min(len(results), SEARCH_COLUMNS*SEARCH_ROWS)
+            if shown < self.app.search_count:
+                status += " (%d shown)" % shown
+        qp.drawText(margin,margin, width-2*margin,line_h, QtCore.Qt.AlignLeft|QtCore.Qt.AlignVCenter,
+             u"Search: %s_" % self.app.search_query)
+        qp.drawText(margin,margin, width-2*margin,line_h, QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter, status)
+        
+        # matching slides
+        top = 2*margin + line_h
+        dx = (width - margin) / SEARCH_COLUMNS
+        dy = (height - top) / SEARCH_ROWS
+        for i, info in enumerate(results[:SEARCH_COLUMNS*SEARCH_ROWS]):
+            row, col = divmod(i, SEARCH_COLUMNS)
+            x = int(margin + col*dx)
+            y = int(top + row*dy)
+            w = int(dx - margin)
+            h = int(dy - margin)
+            if i == self.app.search_selected:
+                qp.setBrush(SEL2)
+            else:
+                qp.setBrush(ICON)
+            qp.setPen(ICON)
+            qp.drawRect(x,y, w,h)
+            image, final = info.get_thumbnail(w-10, h-10)
+            paint_image(qp, image, x,y,w,h)
+            qp.setPen(TEXT)
+            qp.drawText(x+5,y+5, w-10,h-10, QtCore.Qt.AlignRight|QtCore.Qt.AlignBottom, str(info.n+1))
+        
         qp.end()
 
 
-class HelpBox(QtGui.QWidget):
+class TimingOverlay(QtGui.QWidget):
+    "Recent durations of the main stages, shown on the presenter console"
+    
+    STAGES = ("key", "set_current", "refresh", "render", "drawImage",
+              "paint slide", "paint sidebar", "paint status", "paint overview", "paint search",
+              "key to slide", "key to sidebar", "key to status", "key to overview", "remote", "transition")
+    
     def __init__(self, app, view):
         self.app = app
-        super(HelpBox, self).__init__(view)
+        super(TimingOverlay, self).__init__(view)
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self.update)
+    
+    def showEvent(self, e):
+        self._timer.start(500)
+    
+    def hideEvent(self, e):
+        self._timer.stop()
     
     def paintEvent(self, e):
         size = self.size()
         width =  size.width()
         height = size.height()
-        margin = min(width,height) / 20
         
-        help, n,l = self.app.get_help()
+        lines = [ "%-15s %8s %8s" % ("ms", "last", "p95") ]
+        for name in self.STAGES:
+            stats = timing.get_stats(name)
+            if stats:
+                lines.append( "%-15s %8.1f %8.1f" % (name, stats[0], stats[1]) )
         
         qp = QtGui.QPainter()
         qp.begin(self)
-        
         qp.setBrush(HELP_BG)
-        qp.setPen(WHITE)
+        qp.setPen(TEXT)
         qp.drawRect(0,0, width,height)
-        
-        # pick font size
-        dpi = QtGui.QDesktopWidget().physicalDpiX()
-        font_scale = dpi / 96
-        font_size = min(width/(l+4), height/(n+8)) / font_scale
-        help_font = QtGui.QFont('Mono', font_size)
-        
-        qp.setFont(help_font)
-        qp.drawText(margin,margin,width-2*margin,height-2*margin,
-             QtCore.Qt.AlignLeft, help)
-        
+        font_size = height / (len(self.STAGES)+3)
+        qp.setFont(QtGui.QFont('Mono', font_size / (QtGui.QDesktopWidget().physicalDpiX() / 96)))
+        qp.drawText(font_size,font_size, width-2*font_size,height-2*font_size,
+             QtCore.Qt.AlignLeft, "\n".join(lines))
         qp.end()
 
+
+class FrameScheduler(QtCore.QObject):
+    """Coalesce the repaint requests of all widgets:
+        * at most one repaint per frame
+        * only the dirty widgets, or parts of them
+    """
+    
+    def __init__(self):
+        super(FrameScheduler, self).__init__()
+        self.dirty = {}
+        self.last_frame = 0
+        self._timer = QtCore.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.paint)
+    
+    def request(self, widget, rect=None):
+        "Mark a widget (or a rectangle in it) for the next frame"
+        if rect is None:
+            self.dirty[widget] = None
+        elif widget not in self.dirty:
+            self.dirty[widget] = QtGui.QRegion(rect)
+        elif self.dirty[widget] is not None:
+            self.dirty[widget] = self.dirty[widget].united( QtGui.QRegion(rect) )
+        
+        if not self._timer.isActive():
+            elapsed = 1000 * (time.time() - self.last_frame)
+            self._timer.start( max(0, FRAME_INTERVAL - elapsed) )
+    
+    def paint(self, now=False):
+        self.last_frame = time.time()
+        dirty = self.dirty
+        self.dirty = {}
+        for widget, region in dirty.items():
+            # repaint right away, or leave it to the event loop
+            paint = widget.repaint if now else widget.update
+            if region is None:
+                paint()
+            else:
+                paint(region)
+    
+    def flush(self):
+        "Paint the pending frame right away (benchmarks)"
+        self._timer.stop()
+        self.paint(True)
+
+
 class View(QtGui.QFrame):
     """The view, with 3 modes:
         * presenter console:
@@ -523,7 +887,6 @@ class View(QtGui.QFrame):
     def __init__(self, app, desktop_info, target_desktop, is_presenter, is_single):
         self.app = app
         self.doc = app.doc
-        self.link_map = None
         self.presenter_mode = is_presenter
         self.single_mode = is_single
 
@@ -540,6 +903,9 @@ class View(QtGui.QFrame):
         self.overview = Overview(self.app, self)
         self.slideview = SlideView(self.app, self)
         self.helpbox = HelpBox(self.app, self)
+        self.searchbox = SearchBox(self.app, self)
+        self.jumpbox = JumpBox(self.app, self)
+        self.timings = TimingOverlay(self.app, self)
         
         
         # Place the selected view fullscreen on the selected monitor
@@ -576,6 +942,12 @@ class View(QtGui.QFrame):
         self.overview.move(0,0)
         self.helpbox.resize(width,height)
         self.helpbox.move(0,0)
+        self.searchbox.resize(width,height)
+        self.searchbox.move(0,0)
+        self.jumpbox.resize(int(width/2), int(h_bottom))
+        self.jumpbox.move(int(width/4), int(height-h_bottom))
+        self.timings.resize(w_cur/3, h_cur/3)
+        self.timings.move(0,0)
     
     
     def switch_mode(self):
@@ -611,26 +983,84 @@ class View(QtGui.QFrame):
             self.sidebar.hide()
             self.slideview.show()
         
+        if self.app.searching and (self.presenter_mode or self.single_mode):
+            self.searchbox.show()
+            self.searchbox.raise_()
+        else:
+            self.searchbox.hide()
+        
+        # the jump is shown in the status bar, when there is one
+        if self.app.jump_text is not None and (self.presenter_mode or self.single_mode) and self.status.isHidden():
+            self.jumpbox.show()
+            self.jumpbox.raise_()
+        else:
+            self.jumpbox.hide()
+        
+        if timing.ENABLED and self.presenter_mode and not self.app.overview_mode and not self.app.helping:
+            self.timings.show()
+            self.timings.raise_()
+        else:
+            self.timings.hide()
+        
         self.refresh()
     
     def keyPressEvent(self, e):
         self.app.handle_key(e)
     
     def mouseMoveEvent(self, e):
-        l = self.app.has_moved(e, self.link_map)
+        self.app.has_moved()
     
     def refresh(self):
+        if self.app.searching and (self.presenter_mode or self.single_mode):
+            self.searchbox.refresh()
+        if not self.jumpbox.isHidden():
+            self.jumpbox.refresh()
         if self.app.overview_mode and (self.presenter_mode or self.single_mode):
             self.overview.refresh()
         elif self.presenter_mode:
             self.slideview.set_slide(self.app.get_current())
+            self.sidebar.refresh()
+            self.status.refresh()
         else:
             self.slideview.set_slide(self.app.get_slide())
-        self.update()
     
     
     def mouseReleaseEvent(self, evt):
-        self.app.click_map(evt, self.link_map)
+        self.app.click_map()
+    
+    def get_prefetch(self, pages):
+        "List the images that this view needs for the given pages"
+        requests = []
+        if self.app.overview_mode and (self.presenter_mode or self.single_mode):
+            return self.overview.get_prefetch()
+        
+        size = self.slideview.size()
+        width = size.width()
+        height = size.height()
+        if not self.presenter_mode and self.app.freezed:
+            # the main view sticks to the frozen slide
+            return [ (self.app.freezed, width, height, False) ]
+        
+        for info in pages:
+            requests.append( (info, width, height, False) )
+            if self.presenter_mode:
+                for t_info, x,y,w,h, note in self.sidebar.get_targets(info):
+                    if t_info:
+                        requests.append( (t_info, w,h, note) )
+        return requests
+    
+    def rendered(self, info):
+        self.slideview.rendered(info)
+        self.sidebar.rendered(info)
+        self.overview.rendered(info)
+        self.searchbox.rendered(info)
+    
+    def reload(self):
+        "Switch to the new version of the document"
+        self.doc = self.app.doc
+        self.overview.doc = self.app.doc
+        self.overview.geometry = None
+        self.overview.selected = None
     
     def stop_videos(self):
         return self.slideview.stop()
@@ -644,76 +1074,152 @@ class VideoBox(ClickBait):
     "Placeholder widget for inline videos"
     def __init__(self, view, x,y,w,h, media):
         super(VideoBox, self).__init__(view,x,y,w,h)
+        self.app = view.app
         self.media = media
         self.player = None
         self.loop = False
+        self.waiting = False
     
     def activate(self, loop=False):
         self.loop = loop
         if not self.player:
             w = self.size().width()
             h = self.size().height()
-            self.player = Phonon.VideoPlayer( self )
+            self.player = self.app.players.acquire(self.media, self)
             self.player.setGeometry(0,0,w,h)
             self.player.show()
-            self.player.load(self.media)
-            self.player.play()
-            
             self.player.finished.connect(self.finished)
+            
+            if is_extracting(self.media):
+                # never wait in the GUI thread: play once extracted
+                manager = self.app.doc.media_manager
+                self.waiting = True
+                manager.extracted.connect(self.extracted)
+                manager.hurry(self.media)
+                if not is_extracting(self.media):
+                    # done before the connection
+                    self.extracted(self.media)
+            else:
+                self.player.play()
         else:
             self.clear()
     
+    def extracted(self, extraction):
+        if extraction is not self.media:
+            return
+        self.stop_waiting()
+        source = get_video_source(self.media)
+        if self.player and source:
+            self.player.load(source)
+            self.player.play()
+    
+    def stop_waiting(self):
+        if self.waiting:
+            self.waiting = False
+            self.app.doc.media_manager.extracted.disconnect(self.extracted)
+    
     def finished(self):
         if self.player and self.loop:
             self.player.play()
     
     def clear(self):
+        self.stop_waiting()
         if self.player:
-            self.player.stop()
-            self.player.hide()
-            self.player.setParent(None)
+            self.app.players.release(self.player)
             self.player = None
 
 
-def get_media_source(url=None, embeddedFile=None):
-    "Turn an external link or embded file into a playable media source"
+class PlayerPool:
+    """Reusable video players:
+        * players for the upcoming videos are loaded ahead, off-screen
+        * stopped players are kept for the next videos
+    """
+    
+    def __init__(self):
+        # hidden parent for the idle players
+        self.holder = QtGui.QWidget()
+        self.free = []
+        self.prepared = {}
+    
+    def get_player(self):
+        if self.free:
+            return self.free.pop()
+        return Phonon.VideoPlayer(self.holder)
+    
+    def preload(self, medias):
+        "Load the given media in off-screen players, drop the other preloaded ones"
+        prepared = {}
+        for media in medias:
+            key = id(media)
+            if key in self.prepared:
+                prepared[key] = self.prepared.pop(key)
+                continue
+            source = get_video_source(media)
+            if not source:
+                continue
+            player = self.get_player()
+            player.load(source)
+            # start buffering without playing
+            player.pause()
+            prepared[key] = (media, player)
+        
+        for media, player in self.prepared.values():
+            self.release(player)
+        self.prepared = prepared
+    
+    def acquire(self, media, parent):
+        "Get a player for a media, preloaded if possible"
+        entry = self.prepared.pop(id(media), None)
+        if entry:
+            player = entry[1]
+        else:
+            player = self.get_player()
+            source = get_video_source(media)
+            if source:
+                player.load(source)
+        player.setParent(parent)
+        return player
+    
+    def release(self, player):
+        player.stop()
+        player.hide()
+        try:
+            player.finished.disconnect()
+        except TypeError:
+            # nothing connected
+            pass
+        if len(self.free) < PLAYER_POOL:
+            player.setParent(self.holder)
+            self.free.append(player)
+        else:
+            player.setParent(None)
+
+
+def is_extracting(media):
+    "An embedded video still being extracted"
+    return hasattr(media, "wait") and not media.ready.is_set()
+
+def get_video_source(media):
+    "Media source of a video, None for embedded videos not extracted yet"
+    if hasattr(media, "wait"):
+        if is_extracting(media):
+            return None
+        return get_media_source( media.wait() )
+    return media
+
+def get_media_source(url):
+    "Turn an external link or extracted file into a playable media source"
     
     if url:
         try:
             return Phonon.MediaSource(url)
         except:
             print( "Failed to open video file ", url )
-    
-    if embeddedFile:
-        try:
-            videoData = embeddedFile.data()
-            if COPY_EMBEDDED_VIDEO:
-                # first copy the file to /tmp
-                # do not autoremove the temp file: it happens too soon
-                tmp = QtCore.QTemporaryFile()
-                tmp.setAutoRemove(False)
-                tmp.open()
-                tmp.write( videoData )
-                tmp.close()
-                print( "playing embedded file from ", tmp.fileName() )
-                return Phonon.MediaSource( tmp.fileName() )
-            else:
-                # play the embedded file directly: cleaner but not working
-                buff = QtCore.QBuffer( videoData )
-                #buff.open( QtCore.QIODevice.ReadOnly )
-                return Phonon.MediaSource( buff )
-        except:
-            print( "Failed to open video from data" )
-    return media
-
+    return None
 
 
-def place_image(qpainter, info, x,y,w,h, note=False, align=0):
-    "Paint a page info properly aligned in the selected area"
-    if info:
-        image = info.get_image(w,h, note)
-        paint_image(qpainter, image, x,y,w,h, align)
 
+@timing.timed("drawImage")
 def paint_image(qpainter, image, x,y,w,h, align=0):
     if not image:
         return
@@ -0,0 +1,154 @@
+import json
+import hashlib
+import threading
+import traceback
+import collections
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from PyQt4 import QtCore
+
+
+# image format sent to the viewers
+MIRROR_FORMAT = "PNG"
+
+# number of encoded slides kept in memory
+MIRROR_CACHE = 128
+
+# page showing the mirrored slides in a browser
+VIEWER_PAGE = b"""<!DOCTYPE html>
+<html><head><meta name="viewport" content="width=device-width">
+<style>
+html, body { margin: 0; height: 100%; background: black; }
+img { width: 100%; height: 100%; object-fit: contain; }
+</style></head>
+<body>
+<img id="slide">
+<script>
+var slide = document.getElementById("slide");
+var feed = new WebSocket("ws://" + location.host + "/mirror");
+feed.onmessage = function(e) {
+    var frame = JSON.parse(e.data);
+    if (frame.color) {
+        slide.style.visibility = "hidden";
+        document.body.style.background = frame.color;
+    } else if (frame.image) {
+        slide.src = "/image/" + frame.image;
+        slide.style.visibility = "visible";
+        document.body.style.background = "black";
+    }
+};
+</script>
+</body></html>
+"""
+
+
+class Mirror(QtCore.QObject):
+    """Publish the slide shown to the audience to remote viewers:
+        * the image rendered for the slide view is encoded once, in a background thread
+        * images are named by a hash of their content, viewers cache them
+        * viewers only get a short message when the slide changes
+    """
+
+    # emitted with the (key, name) of each encoded image
+    encoded = QtCore.pyqtSignal(object)
+
+    def __init__(self, app):
+        super(Mirror, self).__init__()
+        self.app = app
+        self.lock = threading.Lock()
+        self.images = collections.OrderedDict()
+        self.names = {}
+        # nothing to do until a viewer connects
+        self.enabled = False
+        self.frame = None
+        self.wanted = None
+        self.queued = set()
+        self.listeners = []
+        self.encoded.connect(self.add)
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.encode_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_audience_key(self):
+        "Cache key of the image shown to the audience"
+        for v in self.app.views:
+            if not v.presenter_mode or len(self.app.views) == 1:
+                size = v.slideview.size()
+                return (self.app.get_slide(), False, size.width(), size.height())
+
+    def update(self):
+        "Publish the current audience slide, once its final image is rendered"
+        if not self.enabled:
+            return
+        if self.app.color:
+            return self.publish( {"color": str(self.app.color.name())} )
+
+        key = self.get_audience_key()
+        name = self.names.get(key)
+        if name and self.get(name) is not None:
+            return self.publish( {"image": name} )
+
+        self.wanted = key
+        if key in self.queued:
+            return
+        image = self.app.renderer.peek(*key)
+        if image is None:
+            # encoded once it is rendered
+            self.app.renderer.queue(key)
+        else:
+            self.queued.add(key)
+            self.queue.put( (key, image) )
+
+    def rendered(self, key):
+        if key == self.wanted:
+            self.update()
+
+    def encode_loop(self):
+        while True:
+            key, image = self.queue.get()
+            try:
+                data = QtCore.QByteArray()
+                buffer = QtCore.QBuffer(data)
+                buffer.open(QtCore.QIODevice.WriteOnly)
+                image.save(buffer, MIRROR_FORMAT)
+                data = bytes(data)
+                name = hashlib.sha1(data).hexdigest()
+                with self.lock:
+                    self.images[name] = data
+                    while len(self.images) > MIRROR_CACHE:
+                        self.images.popitem(False)
+                self.encoded.emit( (key, name) )
+            except:
+                traceback.print_exc()
+                self.encoded.emit( (key, None) )
+
+    def add(self, encoded):
+        key, name = encoded
+        self.queued.discard(key)
+        if name is None:
+            return
+        self.names[key] = name
+        # forget the names of the images removed from the cache
+        if len(self.names) > 2*MIRROR_CACHE:
+            with self.lock:
+                self.names = dict( (k, n) for k, n in self.names.items() if n in self.images )
+        if key == self.wanted:
+            self.publish( {"image": name} )
+
+    def get(self, name):
+        "Encoded image with the given name, None if it is unknown"
+        with self.lock:
+            return self.images.get(name)
+
+    def publish(self, frame):
+        self.wanted = None
+        frame = json.dumps(frame)
+        if frame == self.frame:
+            return
+        self.frame = frame
+        for listener in self.listeners:
+            listener(frame)
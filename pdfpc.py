@@ -10,12 +10,18 @@ except:
 
 from doc import *
 from gui import *
+import render
+import remote
+import mirror
+import timing
 
 
-# TODO
-#   multipage overview
-#   caching ?
-#   jump ?
+# interval between two scans of the loaded pages (ms)
+SCAN_INTERVAL = 100
+
+# reload the document when the file changes: interval between two checks (ms), 0 to disable
+WATCH_INTERVAL = 1000
+
 
 class Application(QtGui.QApplication):
     """The root application
@@ -26,7 +32,8 @@ class Application(QtGui.QApplication):
     
     def __init__(self, filename):
     
-        self.doc = Document(filename)
+        self.filename = filename
+        self.doc = Document(filename, WATCH_INTERVAL > 0)
         self.freezed = None
         self.color = None
         self.current = self.doc.pages[0]
@@ -34,8 +41,16 @@ class Application(QtGui.QApplication):
         
         self.first_is_master = None
         self.helping = False
+        self.searching = False
+        self.jump_text = None
+        self.jump_failed = False
+        self.search_query = u""
+        self.search_results = []
+        self.search_count = 0
+        self.search_selected = 0
         self.overview_mode = False
         self.previous_page = None
+        self.previous_overview = None
         
         self.clock_start = None
         self.clock = 0
@@ -43,6 +58,12 @@ class Application(QtGui.QApplication):
         
         QtGui.QApplication.__init__(self, sys.argv)
         
+        self.renderer = render.RenderEngine(self.doc)
+        self.renderer.rendered.connect(self.rendered)
+        self.doc.renderer = self.renderer
+        self.players = PlayerPool()
+        self.scheduler = FrameScheduler()
+        
         self.NO_CURSOR = QtGui.QCursor(QtCore.Qt.BlankCursor)
         self.BASE_CURSOR = QtGui.QCursor(QtCore.Qt.ArrowCursor)
         self.LINK_CURSOR = QtGui.QCursor(QtCore.Qt.PointingHandCursor)
@@ -63,13 +84,107 @@ class Application(QtGui.QApplication):
         
         self.keyhandler = None
         self.keymap = {}
+        self.actions = {}
         for short in KEYMAP:
             cb = short[0]
+            self.actions[cb.__name__] = cb
             for k in short[1:]:
                 self.keymap[k] = cb
         
+        # look again while the text index is being built
+        self.search_timer = QtCore.QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.timeout.connect(self.update_search)
+        
+        # accept commands from clickers and phones, mirror the slides to viewers
+        self.mirror = mirror.Mirror(self)
+        self.remote = remote.RemoteServer(self, self.mirror)
+        
         self.just_starting()
+        
+        # link the pages loaded in the background
+        self.scan_timer = QtCore.QTimer()
+        self.scan_timer.timeout.connect(self.scan)
+        if not self.doc.complete:
+            self.scan_timer.start(SCAN_INTERVAL)
+        
+        # reload the document when it is rebuilt
+        self.file_state = get_file_state(filename)
+        self.next_state = None
+        self.watch_timer = QtCore.QTimer()
+        self.watch_timer.timeout.connect(self.watch)
+        if WATCH_INTERVAL:
+            self.watch_timer.start(WATCH_INTERVAL)
+    
+    def scan(self):
+        "Add the newly loaded pages to the navigation"
+        if self.doc.scan():
+            self.prefetch()
+            for v in self.views:
+                v.refresh()
+        if self.doc.complete:
+            self.scan_timer.stop()
+    
+    def watch(self):
+        "Reload the file once it changed and stopped changing"
+        state = get_file_state(self.filename)
+        if state is None or state == self.file_state:
+            self.next_state = None
+            return
+        if state != self.next_state:
+            # probably still being written: check again later
+            self.next_state = state
+            return
+        self.file_state = state
+        self.next_state = None
+        self.reload()
+    
+    def reload(self):
+        "Load the new version of the file and stay on the same slide"
+        def locate(page):
+            return page and (page.label, page.n, page.o_n)
+        shown = self.current
+        current = locate(self.current)
+        freezed = locate(self.freezed)
+        
+        try:
+            doc = Document(self.filename, True, self.doc)
+        except IOError as e:
+            print( e )
+            return
+        
+        self.stop_videos()
+        self.doc.close()
+        self.doc = doc
+        self.renderer.set_document(doc)
+        self.current = self.find_page(*current)
+        # the slide on screen right away, the others in the background
+        doc.match(shown, self.current)
+        self.freezed = freezed and self.find_page(*freezed)
+        if self.overview_mode:
+            self.current_overview = self.current
+        self.previous_page = None
+        self.previous_overview = None
+        for v in self.views:
+            v.reload()
+        self.update_search()
+        self.refresh()
+        if not doc.complete:
+            self.scan_timer.start(SCAN_INTERVAL)
+    
+    def find_page(self, label, n, o_n):
+        "Find a slide of the reloaded document by label, or by position if the label is gone"
+        doc = self.doc
+        # only wait for the pages up to that position, the others are scanned in the background
+        while len(doc.layout) <= n and not doc.complete:
+            doc.scan(SCAN_START, True)
+        
+        page = doc.labels.get(u"%s" % label)
+        if page is None:
+            page = doc.layout[ min(n, len(doc.layout)-1) ]
+        return page.overlay.get( min(o_n, page.overlay.count-1) )
     
+    @timing.timed("set_current")
     def set_current(self, page):
         self.just_starting()
         if page:
@@ -78,6 +193,38 @@ class Application(QtGui.QApplication):
         if self.overview_mode:
             self.overview()
     
+    def go_to(self, page):
+        "Show a page chosen outside of the overview grid, which would replace it when closing"
+        if self.overview_mode:
+            self.overview(True)
+        self.set_current(page)
+    
+    def prefetch(self, target=None):
+        "Prepare the images of the slides around the current one, or around a jump target"
+        pages = render.get_neighbours(target or self.current, self.renderer.depth)
+        # keep the current and next slides around whatever happens
+        pinned = [ p for p in (self.current, self.current.get_next()) if p ]
+        requests = []
+        pins = []
+        for v in self.views:
+            requests.extend( v.get_prefetch(pages) )
+            pins.extend( v.get_prefetch(pinned) )
+        self.renderer.prefetch(requests, pins)
+    
+    def preload_videos(self):
+        "Prepare players for the videos of the current and next slides"
+        medias = []
+        for info in (self.current, self.current.get_next()):
+            if info and info.get_media():
+                medias.extend( media for x,y,w,h, media in info.get_videos() if media )
+        self.players.preload(medias)
+    
+    def rendered(self, key):
+        "Some background render is done: replace the previews"
+        for v in self.views:
+            v.rendered(key[0])
+        self.mirror.rendered(key)
+    
     def set_current_overview(self, page, finished=False):
         if not self.overview or not page:
             return
@@ -156,13 +303,20 @@ class Application(QtGui.QApplication):
         extra = int( time.time() - self.clock_start )
         return self.clock+extra, False
     
+    @timing.timed("refresh")
     def refresh(self):
         "Trigger a redraw"
         
-        # detect when to stop videos
+        # detect when to stop videos and prepare the next slides
         if self.previous_page != self.current:
             self.previous_page = self.current
             self.stop_videos()
+            self.prefetch()
+            self.preload_videos()
+        elif self.overview_mode and self.previous_overview != self.current_overview:
+            # prepare the thumbnails around the new selection
+            self.previous_overview = self.current_overview
+            self.prefetch()
         
         # hide the cursor if it didn't move for a while
         if self.last_move_time:
@@ -172,29 +326,44 @@ class Application(QtGui.QApplication):
         
         for v in self.views:
             v.refresh()
+        self.remote.notify()
+        self.mirror.update()
+    
+    def schedule(self, widget, rect=None):
+        "Repaint a widget (or part of it) with the next frame"
+        self.scheduler.request(widget, rect)
     
-    def has_moved(self, evt, links):
+    def has_moved(self, target=None):
+        "Track mouse moves, show when it is over a link"
         self.last_move_time = time.time()
-        l = find_link(evt, links)
-        if l:
-            QtGui.QApplication.setOverrideCursor(self.LINK_CURSOR)
+        if target:
+            cursor = self.LINK_CURSOR
         else:
-            QtGui.QApplication.setOverrideCursor(self.BASE_CURSOR)
-        return l
+            cursor = self.BASE_CURSOR
+        if QtGui.QApplication.overrideCursor():
+            QtGui.QApplication.changeOverrideCursor(cursor)
+        else:
+            QtGui.QApplication.setOverrideCursor(cursor)
     
     def grab_keys(self, handler):
         self.keyhandler = handler
     
+    @timing.timed("key")
     def handle_key(self, e):
         "Keyboard shortcuts: use a predefined keymap"
+        timing.key_pressed()
         if type(e) == QtGui.QKeyEvent:
             if self.helping:
                 self.help()
                 return
             
             key = e.key()
-            if self.keyhandler:
-                self.keyhandler.handle_key()
+            if QtCore.Qt.Key_0 <= key <= QtCore.Qt.Key_9 and not self.keyhandler:
+                # typing a number starts a jump
+                self.jump()
+            if self.keyhandler and self.keyhandler(e):
+                e.accept()
+                return
             if key in self.keymap:
                 e.accept()
                 callback = self.keymap[key]
@@ -203,6 +372,39 @@ class Application(QtGui.QApplication):
         
         e.ignore()
     
+    def run_action(self, name):
+        "Run an action of the keymap by name (remote control), False if there is none"
+        callback = self.actions.get(name)
+        if not callback:
+            return False
+        timing.key_pressed()
+        if self.helping:
+            self.help()
+        else:
+            callback(self)
+        return True
+    
+    def get_state(self):
+        "Summary of the presentation state, for remote controls"
+        seconds, paused = self.get_clock()
+        current = self.current
+        color = None
+        if self.color:
+            color = str( self.color.name() )
+        return {
+            "slide": current.n + 1,
+            "slides": len(self.doc.layout),
+            "overlay": current.o_n + 1,
+            "overlays": current.overlay.count,
+            "label": u"%s" % current.label,
+            "clock": seconds,
+            "paused": paused,
+            "frozen": self.freezed is not None,
+            "color": color,
+            "overview": self.overview_mode,
+            "complete": self.doc.complete,
+        }
+    
     def switch(self):
         "Switch slide/presenter screens"
         for v in self.views:
@@ -241,9 +443,119 @@ class Application(QtGui.QApplication):
             self.color = color
         self.refresh()
     
+    def timings(self):
+        "Show the time spent in each step on the presenter screen"
+        timing.enable(not timing.ENABLED)
+        for v in self.views:
+            v.config_view()
+    
     def jump(self):
-        "[TODO] jump to a  given slide"
-        print( "TODO: jump" )
+        "Go to a slide: type its number or label, then Enter"
+        self.jump_failed = False
+        if self.jump_text is None:
+            self.jump_text = u""
+            self.grab_keys(self.jump_key)
+        else:
+            self.jump_text = None
+            self.grab_keys(None)
+        for v in self.views:
+            v.config_view()
+    
+    def get_jump_text(self):
+        "The jump being typed, None when there is none"
+        if self.jump_text is None:
+            return None
+        if self.jump_failed:
+            return u"Go to: %s_ (no such slide)" % self.jump_text
+        return u"Go to: %s_" % self.jump_text
+    
+    def jump_key(self, e):
+        "Edit the target of the jump, returns True if the key was used"
+        key = e.key()
+        if key == QtCore.Qt.Key_Escape:
+            self.jump()
+        elif key in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter):
+            target = self.doc.find_slide(self.jump_text)
+            if not target:
+                # stay in the jump to fix the text
+                self.jump_failed = True
+                self.refresh()
+                return True
+            self.jump()
+            self.go_to(target)
+        elif key == QtCore.Qt.Key_Backspace:
+            self.jump_text = self.jump_text[:-1]
+            self.jump_typed()
+        else:
+            text = u"%s" % e.text()
+            if not text or text < u" ":
+                return False
+            self.jump_text += text
+            self.jump_typed()
+        return True
+    
+    def jump_typed(self):
+        self.jump_failed = False
+        # render the target while the number is typed: Enter shows it right away
+        target = self.doc.find_slide(self.jump_text)
+        if target:
+            self.prefetch(target)
+        self.refresh()
+    
+    def search(self):
+        "Find slides by their text, Enter jumps to the selected one"
+        self.searching = not self.searching
+        self.search_query = u""
+        self.search_results = []
+        self.search_count = 0
+        self.search_selected = 0
+        if self.searching:
+            self.grab_keys(self.search_key)
+        else:
+            self.grab_keys(None)
+        for v in self.views:
+            v.config_view()
+    
+    def search_key(self, e):
+        "Edit the search query, returns True if the key was used"
+        key = e.key()
+        if key == QtCore.Qt.Key_Escape:
+            self.search()
+        elif key in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter):
+            target = None
+            if self.search_results:
+                target = self.search_results[self.search_selected]
+            # nothing found: close the search rather than keep the keyboard
+            self.search()
+            if target:
+                self.go_to(target)
+        elif key == QtCore.Qt.Key_Backspace:
+            self.search_query = self.search_query[:-1]
+            self.update_search()
+        elif key in (QtCore.Qt.Key_Right, QtCore.Qt.Key_Down, QtCore.Qt.Key_Tab):
+            self.search_selected = max(0, min(self.search_selected+1, len(self.search_results)-1))
+            self.refresh()
+        elif key in (QtCore.Qt.Key_Left, QtCore.Qt.Key_Up):
+            self.search_selected = max(0, self.search_selected-1)
+            self.refresh()
+        else:
+            text = u"%s" % e.text()
+            if not text or text < u" ":
+                return False
+            self.search_query += text
+            self.update_search()
+        return True
+    
+    def update_search(self):
+        if not self.searching:
+            return
+        index = self.doc.text_index
+        self.search_results, self.search_count = index.search(self.search_query)
+        self.search_selected = 0
+        for v in self.views:
+            v.refresh()
+        if self.search_query and not index.complete:
+            self.search_timer.start(500)
     
     def start(self):
         "Jump to the first slide"
@@ -265,9 +577,11 @@ class Application(QtGui.QApplication):
             if not escape and self.current_overview:
                 self.current = self.current_overview
             self.current_overview = None
+            self.previous_overview = None
         self.overview_mode = not self.overview_mode
         for v in self.views:
             v.config_view()
+        self.refresh()
     
     def overview_move(self, backward, vertical):
         if backward:
@@ -302,6 +616,12 @@ class Application(QtGui.QApplication):
         if self.helping:
             return self.help()
         
+        if self.searching:
+            return self.search()
+        
+        if self.jump_text is not None:
+            return self.jump()
+        
         if self.overview_mode:
             return self.overview(True)
         
@@ -314,6 +634,12 @@ class Application(QtGui.QApplication):
         if self.clock_start:
             return self.pause()
         
+        if render.SHOW_STATS:
+            print( "render cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(bytes)d bytes" % self.renderer.get_stats() )
+        if self.doc.server:
+            self.doc.server.stop()
+        if timing.DUMP_FILE:
+            timing.dump(timing.DUMP_FILE)
         QtGui.QApplication.quit()
     
     def help(self):
@@ -325,38 +651,31 @@ class Application(QtGui.QApplication):
     def get_help(self):
         return get_help()
     
-    def click_map(self, evt, links):
-        "Detect if a link was clicked"
+    def click_map(self, target=None):
+        "Follow a clicked link"
         if self.helping:
             self.help()
             return
         
-        l = find_link(evt, links)
-        if not l:
+        if not target:
             return
-        lx,ly,lx2,ly2, target = l
         if isinstance(target, PageInfo):
             self.current = target
             if self.overview_mode:
                 self.overview_mode = False
             self.refresh()
         else:
-            print( "Unsupported link type?" )
+            # click on a video
+            self.video()
 
 
-def find_link(evt, links):
-    if not links:
-        return
-    
-    pos = evt.pos()
-    x = pos.x()
-    y = pos.y()
-    
-    for l in links:
-        lx,ly,lx2,ly2, target = l
-        if x > lx and x < lx2 and y>ly and y < ly2:
-            if isinstance(target, PageInfo):
-                return l
+def get_file_state(filename):
+    "Modification time and size of a file, None if it is missing"
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
 
 
 K = QtCore.Qt
@@ -380,7 +699,9 @@ KEYMAP = [
     (A.reset,     K.Key_R, ),
     
     (A.help,      K.Key_H, K.Key_Question),
-#    (A.jump,      K.Key_G, K.Key_J),
+    (A.timings,   K.Key_T, ),
+    (A.jump,      K.Key_G, K.Key_J),
+    (A.search,    K.Key_Slash, ),
     (A.video,      K.Key_V, ),
     (A.loop,      K.Key_L, ),
     (A.overview,  K.Key_Tab, K.Key_O, ),
@@ -430,8 +751,14 @@ def get_help():
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--export":
+        # render the slides to image files, without the interface
+        import export
+        sys.exit( 0 if export.main(sys.argv[2:]) else 1 )
+    
     if len(sys.argv) != 2:
         print( "Usage: %s <filename.pdf>" % sys.argv[0] )
+        print( "       %s --export [--help] <filename.pdf>" % sys.argv[0] )
         print()
         print( get_help()[0] )
         print()
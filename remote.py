@@ -0,0 +1,370 @@
+#! /usr/bin/python
+
+import re
+import json
+import time
+import base64
+import struct
+import hashlib
+import argparse
+from PyQt4 import QtCore, QtNetwork
+from mirror import VIEWER_PAGE, MIRROR_FORMAT
+import timing
+
+
+# listen for remote commands on this address and port (0 to disable),
+# use "0.0.0.0" to accept phones and clickers from other machines
+REMOTE_HOST = "127.0.0.1"
+REMOTE_PORT = 8473
+
+# name of the local socket (None to disable)
+REMOTE_SOCKET = "pdfpc"
+
+# maximal size of a pending request (bytes): larger ones close the connection
+MAX_REQUEST = 64 * 1024
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC11B85"
+
+HTTP_REQUEST = re.compile(br"^[A-Z]+ \S+ HTTP/")
+
+# read-only requests, the actions need a POST
+READ_ONLY = ("state", "latency")
+
+# minimal page for phones
+REMOTE_PAGE = b"""<!DOCTYPE html>
+<html><head><meta name="viewport" content="width=device-width">
+<style>button { width: 45%; height: 30vh; font-size: 2em; margin: 1%; }</style></head>
+<body>
+<button onclick="send('prev')">&larr;</button><button onclick="send('next')">&rarr;</button>
+<button onclick="send('black')">black</button><button onclick="send('freeze')">freeze</button>
+<pre id="state"></pre>
+<script>
+function show(state) { document.getElementById("state").textContent = state; }
+function send(action) { fetch("/" + action, {method: "POST"}).then(function(r) { return r.text(); }).then(show); }
+var feed = new WebSocket("ws://" + location.host + "/feed");
+feed.onmessage = function(e) { show(e.data); };
+</script>
+</body></html>
+"""
+
+
+class RemoteServer(QtCore.QObject):
+    """Control the presentation from other programs (clickers, phones):
+        * one action per line on a TCP port or a local socket
+        * HTTP on the same port: POST /<action>, GET /state,
+          and a WebSocket feed of the state at /feed
+        * web pages from other sites can not use it: browsers must
+          name this machine by address and send a matching Origin
+        * commands run in the event loop as soon as they arrive,
+          the dispatch latency is recorded as "remote"
+        * the audience slide is mirrored to viewers: /viewer page,
+          WebSocket feed at /mirror and the images at /image/<name>
+    """
+
+    def __init__(self, app, mirror=None):
+        super(RemoteServer, self).__init__()
+        self.app = app
+        self.clients = []
+        self.state = None
+        self.mirror = mirror
+        if mirror:
+            mirror.listeners.append(self.send_frame)
+
+        if REMOTE_PORT:
+            self.tcp_server = QtNetwork.QTcpServer(self)
+            self.tcp_server.newConnection.connect(lambda: self.accept(self.tcp_server))
+            if not self.tcp_server.listen(QtNetwork.QHostAddress(REMOTE_HOST), REMOTE_PORT):
+                print( "Remote control: can not listen on %s:%d" % (REMOTE_HOST, REMOTE_PORT) )
+
+        if REMOTE_SOCKET:
+            self.local_server = QtNetwork.QLocalServer(self)
+            self.local_server.newConnection.connect(lambda: self.accept(self.local_server))
+            if not self.local_server.listen(REMOTE_SOCKET) and not self.reclaim_socket():
+                print( "Remote control: can not listen on "+REMOTE_SOCKET )
+
+    def reclaim_socket(self):
+        "Take over a local socket left behind by a previous session, not one still in use"
+        socket = QtNetwork.QLocalSocket()
+        socket.connectToServer(REMOTE_SOCKET)
+        if socket.waitForConnected(200):
+            socket.disconnectFromServer()
+            return False
+        QtNetwork.QLocalServer.removeServer(REMOTE_SOCKET)
+        return self.local_server.listen(REMOTE_SOCKET)
+
+    def accept(self, server):
+        while server.hasPendingConnections():
+            self.clients.append( RemoteClient(self, server.nextPendingConnection()) )
+
+    def remove(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def run(self, command, received):
+        "Run an action, return the reply to send"
+        command = command.strip()
+        if command == "state":
+            return self.get_state()
+        if command == "latency":
+            return json.dumps( timing.get_stats("remote") )
+
+        found = self.app.run_action(command)
+        timing.record("remote", received, timing.clock())
+        if not found:
+            return json.dumps( {"error": "unknown action", "actions": sorted(self.app.actions)} )
+        return self.get_state()
+
+    def get_state(self):
+        return json.dumps( self.app.get_state(), sort_keys=True )
+
+    def notify(self):
+        "Send the state to the watching clients when it changed"
+        watchers = [ client for client in self.clients if client.watching ]
+        if not watchers:
+            return
+        state = self.get_state()
+        if state == self.state:
+            return
+        self.state = state
+        for client in watchers:
+            client.send(state)
+
+    def send_frame(self, frame):
+        "Tell the viewers which image to show: the message is the same for all of them"
+        for client in self.clients:
+            if client.mirroring:
+                client.send(frame)
+
+
+class RemoteClient(object):
+    "Connection of a remote control: line protocol, HTTP request or WebSocket"
+
+    def __init__(self, server, socket):
+        self.server = server
+        self.socket = socket
+        self.buffer = bytearray()
+        self.mode = None
+        self.watching = False
+        self.mirroring = False
+        socket.readyRead.connect(self.read)
+        socket.disconnected.connect(self.close)
+
+    def read(self):
+        received = timing.clock()
+        self.buffer.extend( bytes(self.socket.readAll()) )
+        if len(self.buffer) > MAX_REQUEST:
+            print( "Remote control: request too large, closing the connection" )
+            self.buffer = bytearray()
+            self.socket.abort()
+            return
+
+        if self.mode is None:
+            if b"\n" not in self.buffer:
+                return
+            if HTTP_REQUEST.match(self.buffer):
+                self.mode = "http"
+            else:
+                self.mode = "line"
+
+        if self.mode == "line":
+            while b"\n" in self.buffer:
+                line, ignored, self.buffer = self.buffer.partition(b"\n")
+                command = line.decode("utf-8", "replace").strip()
+                if command == "watch":
+                    self.watching = True
+                    self.send( self.server.get_state() )
+                elif command:
+                    self.send( self.server.run(command, received) )
+        elif self.mode == "http":
+            if b"\r\n\r\n" in self.buffer:
+                self.read_request(received)
+        elif self.mode == "websocket":
+            self.read_frames(received)
+
+    def read_request(self, received):
+        request, ignored, self.buffer = self.buffer.partition(b"\r\n\r\n")
+        lines = request.decode("utf-8", "replace").split("\r\n")
+        request_line = lines[0].split(" ")
+        headers = {}
+        for line in lines[1:]:
+            name, ignored, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if len(request_line) != 3 or request_line[0] not in ("GET", "POST") or not request_line[1].startswith("/"):
+            return self.reply_and_close(b"", "text/plain", "400 Bad Request")
+        method, path = request_line[:2]
+        if not self.is_allowed(headers):
+            return self.reply_and_close(b"", "text/plain", "403 Forbidden")
+
+        if headers.get("upgrade", "").lower() == "websocket":
+            key = headers.get("sec-websocket-key", "").encode("ascii")
+            accept = base64.b64encode( hashlib.sha1(key + WEBSOCKET_GUID).digest() )
+            self.socket.write( b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                               b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n" )
+            self.mode = "websocket"
+            mirror = self.server.mirror
+            if path == "/mirror" and mirror:
+                self.mirroring = True
+                if mirror.frame:
+                    self.send(mirror.frame)
+                if not mirror.enabled:
+                    # first viewer: start encoding the slides
+                    mirror.enabled = True
+                    mirror.update()
+            else:
+                self.watching = True
+                self.send( self.server.get_state() )
+            return
+
+        mirror = self.server.mirror
+        command = path.strip("/")
+        if path == "/":
+            self.reply(REMOTE_PAGE, "text/html")
+        elif path == "/viewer" and mirror:
+            self.reply(VIEWER_PAGE, "text/html")
+        elif path.startswith("/image/") and mirror:
+            image = mirror.get( path[len("/image/"):] )
+            if image is None:
+                self.reply(b"", "text/plain", "404 Not Found")
+            else:
+                # named by content: viewers never need to ask twice
+                self.reply(image, "image/" + MIRROR_FORMAT.lower(), headers="Cache-Control: public, max-age=31536000, immutable\r\n")
+        elif method != "POST" and command not in READ_ONLY:
+            self.reply(b"", "text/plain", "405 Method Not Allowed", "Allow: POST\r\n")
+        else:
+            self.reply( self.server.run(command, received).encode("utf-8"), "application/json" )
+        self.disconnect()
+
+    def is_allowed(self, headers):
+        """Refuse requests made by web pages of other sites: the host must be named
+        by address (a name could be rebound to this machine), and browsers always
+        send the origin of the page for POST and WebSocket requests
+        """
+        host = headers.get("host", "")
+        if host.startswith("["):
+            name = host[1:].partition("]")[0]
+        else:
+            name = host.partition(":")[0]
+        if name != "localhost" and not QtNetwork.QHostAddress().setAddress(name):
+            return False
+        origin = headers.get("origin")
+        return origin is None or origin == "http://" + host
+
+    def reply(self, body, content_type, status="200 OK", headers=""):
+        self.socket.write( ("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s"
+                            "Connection: close\r\n\r\n" % (status, content_type, len(body), headers)).encode("ascii") )
+        self.socket.write(body)
+
+    def reply_and_close(self, body, content_type, status):
+        self.reply(body, content_type, status)
+        self.disconnect()
+
+    def disconnect(self):
+        self.buffer = bytearray()
+        if isinstance(self.socket, QtNetwork.QLocalSocket):
+            self.socket.disconnectFromServer()
+        else:
+            self.socket.disconnectFromHost()
+
+    def read_frames(self, received):
+        while True:
+            frame = decode_frame(self.buffer)
+            if frame is None:
+                return
+            opcode, payload, self.buffer = frame
+            if opcode == 1 and self.mirroring:
+                # viewers only watch the slides
+                continue
+            elif opcode == 1:
+                self.send( self.server.run(payload.decode("utf-8", "replace"), received) )
+            elif opcode == 8:
+                self.socket.write( encode_frame(b"", 8) )
+                self.socket.close()
+                return
+            elif opcode == 9:
+                self.socket.write( encode_frame(payload, 10) )
+
+    def send(self, message):
+        data = message.encode("utf-8")
+        if self.mode == "websocket":
+            self.socket.write( encode_frame(data) )
+        else:
+            self.socket.write( data + b"\n" )
+        self.socket.flush()
+
+    def close(self):
+        self.watching = False
+        self.server.remove(self)
+        self.socket.deleteLater()
+
+
+def encode_frame(payload, opcode=1):
+    "Build a single, unmasked WebSocket frame"
+    header = bytearray( [0x80 | opcode] )
+    n = len(payload)
+    if n < 126:
+        header.append(n)
+    elif n < 65536:
+        header.append(126)
+        header.extend( struct.pack(">H", n) )
+    else:
+        header.append(127)
+        header.extend( struct.pack(">Q", n) )
+    return bytes(header) + payload
+
+def decode_frame(data):
+    "Read a WebSocket frame: returns (opcode, payload, remaining data), None if it is incomplete"
+    if len(data) < 2:
+        return None
+    opcode = data[0] & 0x0f
+    masked = data[1] & 0x80
+    n = data[1] & 0x7f
+    pos = 2
+    if n == 126:
+        if len(data) < 4:
+            return None
+        n = struct.unpack(">H", bytes(data[2:4]))[0]
+        pos = 4
+    elif n == 127:
+        if len(data) < 10:
+            return None
+        n = struct.unpack(">Q", bytes(data[2:10]))[0]
+        pos = 10
+    mask = None
+    if masked:
+        if len(data) < pos+4:
+            return None
+        mask = data[pos:pos+4]
+        pos += 4
+    if len(data) < pos+n:
+        return None
+    payload = bytearray(data[pos:pos+n])
+    if mask:
+        for i in range(n):
+            payload[i] ^= mask[i % 4]
+    return opcode, bytes(payload), data[pos+n:]
+
+
+if __name__ == "__main__":
+    # loopback client: send commands and measure the round trip
+    import socket
+    parser = argparse.ArgumentParser(description="Send commands to a running pdfpc")
+    parser.add_argument("commands", nargs="*", help="actions to run (next, prev, overview, freeze, black...), or state")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=REMOTE_PORT)
+    parser.add_argument("--watch", action="store_true", help="print the state when it changes")
+    args = parser.parse_args()
+
+    connection = socket.create_connection( (args.host, args.port) )
+    replies = connection.makefile("rb")
+    for command in args.commands:
+        start = time.time()
+        connection.sendall( (command+"\n").encode("utf-8") )
+        reply = replies.readline().decode("utf-8").strip()
+        print( "%s (%.1f ms)" % (reply, 1000 * (time.time() - start)) )
+
+    if args.watch:
+        connection.sendall( b"watch\n" )
+        for line in replies:
+            print( line.decode("utf-8").strip() )
+    connection.close()
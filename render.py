@@ -0,0 +1,930 @@
+import os
+import time
+import mmap
+import ctypes
+import struct
+import hashlib
+import tempfile
+import itertools
+import threading
+import traceback
+import collections
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import sip
+from PyQt4 import QtGui, QtCore
+
+
+# number of slides rendered ahead of (and behind) the current one
+PREFETCH_DEPTH = 2
+
+# memory budget for the rendered images (in bytes)
+CACHE_SIZE = 256 * 1024 * 1024
+
+# size limit of the persistent cache (in bytes, 0 to disable it)
+DISK_CACHE_SIZE = 1024 * 1024 * 1024
+
+# number of separate render processes (0 to render in the application)
+RENDER_PROCESSES = 0
+
+# give up on a render process after this delay (in seconds)
+RENDER_TIMEOUT = 10
+
+# show a quick preview (scaled from another size) while rendering a missing slide
+PROGRESSIVE = True
+
+# color of the blank frame shown when there is nothing to scale (0xAARRGGBB)
+PLACEHOLDER = 0xff000000
+
+# size of the thumbnails kept for all slides
+THUMB_WIDTH = 240
+THUMB_HEIGHT = 180
+
+# number of thumbnails per row and column in each atlas sheet
+ATLAS_CELLS = 8
+
+# memory limit of the atlas sheets (in bytes), at most a quarter of the image cache:
+# the thumbnails of the other slides are rendered on demand
+ATLAS_SIZE = 48 * 1024 * 1024
+
+# number of thumbnails kept scaled to the sizes asked for
+ATLAS_SCALED = 64
+
+# print the render statistics when leaving
+SHOW_STATS = False
+
+
+class ImageCache:
+    """Document-wide cache of rendered images:
+        * keyed by (page, note, width, height)
+        * bounded by a memory budget: least recently used images go first
+        * pinned images (current and next slides) are never evicted
+    """
+
+    def __init__(self, budget=CACHE_SIZE):
+        self.budget = budget
+        self.lock = threading.RLock()
+        self.images = collections.OrderedDict()
+        self.pinned = set()
+        self.owners = {}
+        self.size = 0
+        self.reserved = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is None:
+                self.misses += 1
+                return None
+            # reinsert as most recently used
+            self.images[key] = image
+            self.hits += 1
+            return image
+
+    def find(self, info, note):
+        "Find the largest image available for a page, whatever its size"
+        best = None
+        with self.lock:
+            for key, image in self.images.items():
+                if key[0] is info and key[1] == note:
+                    if best is None or image.width() > best.width():
+                        best = image
+        return best
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.images
+
+    def add(self, key, image):
+        if image is None:
+            return
+        with self.lock:
+            old = self.images.pop(key, None)
+            if old is not None:
+                self.account(old, -1)
+            self.images[key] = image
+            self.account(image, 1)
+            self.evict()
+
+    def account(self, image, delta):
+        "Track memory usage, images sharing the same pixels are counted once"
+        base = getattr(image, "base", image)
+        refs = self.owners.get(id(base), 0)
+        if refs == 0:
+            self.size += base.byteCount()
+        refs += delta
+        if refs == 0:
+            self.size -= base.byteCount()
+            del self.owners[id(base)]
+        else:
+            self.owners[id(base)] = refs
+
+    def reserve(self, size):
+        "Count memory used outside of the cache (thumbnail sheets) in the budget"
+        with self.lock:
+            self.size += size
+            self.reserved += size
+            self.evict()
+
+    def pin(self, keys):
+        "Protect the given keys from eviction, replacing the previous pins"
+        with self.lock:
+            self.pinned = set(keys)
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            for key in list(self.images):
+                if self.size <= self.budget:
+                    break
+                if key in self.pinned:
+                    continue
+                self.account(self.images.pop(key), -1)
+                self.evictions += 1
+
+    def share(self, old, new, note):
+        "Use the images of a page for an identical one (after a reload)"
+        with self.lock:
+            for key in [ key for key in self.images if key[0] is old and key[1] == note ]:
+                new_key = (new,) + key[1:]
+                if new_key not in self.images:
+                    self.images[new_key] = self.images[key]
+                    self.account(self.images[key], 1)
+
+    def forget(self, doc):
+        "Remove the images of an old version of the document"
+        with self.lock:
+            for key in [ key for key in self.images if key[0].doc is doc ]:
+                self.account(self.images.pop(key), -1)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "images": len(self.images),
+                "bytes": self.size,
+                "reserved": self.reserved,
+                "budget": self.budget,
+            }
+
+
+class DiskCache:
+    """Persistent cache of rendered images, to speed up restarts:
+        * one folder per PDF file version in the XDG cache folder
+        * raw pixels behind a small header: nothing to decode
+        * files are written in a background thread
+        * least recently used files are removed above the size limit
+    """
+
+    MAGIC = b"PDFPC1"
+    HEADER = struct.Struct("<6s4i")
+
+    def __init__(self, file_key, budget=DISK_CACHE_SIZE):
+        self.budget = budget
+        self.root = get_cache_folder("images")
+        self.folder = os.path.join(self.root, file_key)
+        self.hits = 0
+        self.misses = 0
+        self.total = None
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def get_path(self, name):
+        return os.path.join(self.folder, name + ".img")
+
+    def get(self, name):
+        path = self.get_path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, width, height, bpl, fmt = self.HEADER.unpack_from(data)
+            pixels = data[self.HEADER.size:]
+            # a truncated file would make Qt read past the end of the pixels
+            if magic != self.MAGIC or width <= 0 or height <= 0 or bpl <= 0 or len(pixels) < bpl * height:
+                raise ValueError(path)
+            # copy to detach the image from the file buffer
+            image = QtGui.QImage(pixels, width, height, bpl, fmt).copy()
+            # remember the usage for the eviction
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, struct.error):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image
+
+    def put(self, name, image):
+        if image is not None:
+            if isinstance(image, SubImage):
+                # the rows of a sub image are not contiguous
+                image = image.copy()
+            self.queue.put( (name, image) )
+
+    def write_loop(self):
+        while True:
+            name, image = self.queue.get()
+            try:
+                self.write(name, image)
+            except (IOError, OSError):
+                traceback.print_exc()
+
+    def write(self, name, image):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = self.get_path(name)
+        tmp = path + ".tmp"
+        header = self.HEADER.pack(self.MAGIC, image.width(), image.height(), image.bytesPerLine(), image.format())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(header)
+                f.write(image.constBits().asstring(image.byteCount()))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # do not leave a partial file behind (disk full)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        if self.total is None:
+            self.total = self.get_usage()
+        else:
+            self.total += self.HEADER.size + image.byteCount()
+        if self.total > self.budget:
+            self.evict()
+
+    def list_files(self):
+        files = []
+        for folder, dirs, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append( (st.st_mtime, st.st_size, path) )
+        return files
+
+    def get_usage(self):
+        return sum( size for mtime, size, path in self.list_files() )
+
+    def evict(self):
+        "Remove the oldest files, leaving some room for the next ones"
+        files = self.list_files()
+        files.sort()
+        total = sum( size for mtime, size, path in files )
+        target = self.budget * 0.9
+        for mtime, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total = total
+
+    def get_stats(self):
+        return { "disk_hits": self.hits, "disk_misses": self.misses }
+
+
+def get_cache_folder(name):
+    "Folder for persistent data in the XDG cache folder"
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pypdfpc", name)
+
+
+def get_file_key(filename):
+    "Identify a version of a file by its path, size and modification time, without reading it"
+    st = os.stat(filename)
+    identity = "%s:%d:%r" % (os.path.realpath(filename), st.st_size, st.st_mtime)
+    return hashlib.sha1( identity.encode("utf-8") ).hexdigest()
+
+
+class RenderServer:
+    """Render pages in separate processes:
+        * each worker process opens its own poppler document
+        * pixels come back in shared memory, wrapped as QImage without copy
+        * render() blocks the calling thread only
+        * crashed workers are restarted, their renders are done in the application
+    """
+
+    def __init__(self, filename, processes=RENDER_PROCESSES):
+        # Qt does not like to be forked: start fresh processes when possible
+        if hasattr(multiprocessing, "get_context"):
+            self.ctx = multiprocessing.get_context("spawn")
+        else:
+            self.ctx = multiprocessing
+        self.filename = filename
+        self.processes = processes
+        self.stopped = False
+        self.requests = self.ctx.Queue()
+        self.results = self.ctx.Queue()
+        self.workers = [ self.start_worker() for i in range(processes) ]
+
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.counter = itertools.count()
+        self.reader = threading.Thread(target=self.read_loop)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def start_worker(self):
+        worker = self.ctx.Process(target=serve, args=(self.filename, self.requests, self.results))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def render(self, index, dpi, x, y, w, h, antialias=True):
+        "Render a page area, None if the worker failed"
+        rid = next(self.counter)
+        slot = [threading.Event(), None]
+        with self.lock:
+            self.waiting[rid] = slot
+        self.requests.put( (rid, index, dpi, x, y, w, h, antialias) )
+        slot[0].wait(RENDER_TIMEOUT)
+        with self.lock:
+            self.waiting.pop(rid, None)
+        if not slot[1]:
+            return None
+        return open_shared_image(*slot[1])
+
+    def read_loop(self):
+        while True:
+            try:
+                item = self.results.get(True, 1)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            if item is None:
+                break
+            rid, result = item
+            with self.lock:
+                slot = self.waiting.pop(rid, None)
+            if slot:
+                slot[1] = result
+                slot[0].set()
+            elif result:
+                # nobody is waiting anymore: release the memory
+                os.remove(result[0])
+
+    def check_workers(self):
+        "Restart the crashed workers, the renders waiting are given up"
+        dead = [ worker for worker in self.workers if not worker.is_alive() ]
+        if not dead or self.stopped:
+            return
+        print( "Restarting %d render process(es)" % len(dead) )
+        for worker in dead:
+            self.workers.remove(worker)
+            self.workers.append( self.start_worker() )
+        self.release()
+
+    def release(self):
+        "Wake up the threads waiting for a render, without result"
+        with self.lock:
+            waiting = list(self.waiting.values())
+            self.waiting = {}
+        for slot in waiting:
+            slot[0].set()
+
+    def stop(self):
+        self.stopped = True
+        for worker in self.workers:
+            self.requests.put(None)
+        # also end the read loop
+        self.results.put(None)
+        self.release()
+
+
+class SharedImage(QtGui.QImage):
+    "QImage on top of a shared memory buffer, which lives as long as the image"
+
+    def __init__(self, buffer, width, height, bpl, fmt):
+        address = ctypes.addressof( ctypes.c_char.from_buffer(buffer) )
+        super(SharedImage, self).__init__(sip.voidptr(address), width, height, bpl, QtGui.QImage.Format(fmt))
+        self.buffer = buffer
+
+
+class SubImage(QtGui.QImage):
+    "Area of a larger image, sharing its pixels"
+
+    def __init__(self, base, x, y, w, h):
+        x = max(0, int(round(x)))
+        y = max(0, int(round(y)))
+        w = min(int(round(w)), base.width() - x)
+        h = min(int(round(h)), base.height() - y)
+        bpl = base.bytesPerLine()
+        address = int(base.constBits()) + y*bpl + x*base.depth()//8
+        super(SubImage, self).__init__(sip.voidptr(address), w, h, bpl, base.format())
+        self.base = base
+
+
+def get_shared_folder():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def open_shared_image(path, width, height, bpl, fmt):
+    "Map the pixels written by a render process, the file itself is removed right away"
+    fd = os.open(path, os.O_RDWR)
+    try:
+        buffer = mmap.mmap(fd, bpl*height)
+    finally:
+        os.close(fd)
+        os.remove(path)
+    return SharedImage(buffer, width, height, bpl, fmt)
+
+
+def write_shared_image(image):
+    "Copy rendered pixels into a shared memory file"
+    size = image.byteCount()
+    fd, path = tempfile.mkstemp(prefix="pdfpc-", dir=get_shared_folder())
+    try:
+        os.ftruncate(fd, size)
+        buffer = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    target = ctypes.c_char.from_buffer(buffer)
+    ctypes.memmove(ctypes.addressof(target), int(image.constBits()), size)
+    del target
+    buffer.close()
+    return (path, image.width(), image.height(), image.bytesPerLine(), int(image.format()))
+
+
+def serve(filename, requests, results):
+    "Main loop of the render processes"
+    import popplerqt4
+    doc = popplerqt4.Poppler.Document.load(filename)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        rid, index, dpi, x, y, w, h, antialias = request
+        result = None
+        try:
+            doc.setRenderHint(popplerqt4.Poppler.Document.TextAntialiasing, antialias)
+            doc.setRenderHint(popplerqt4.Poppler.Document.Antialiasing, antialias)
+            image = doc.page(index).renderToImage(dpi, dpi, x, y, w, h)
+            if not image.isNull():
+                result = write_shared_image(image)
+        except:
+            traceback.print_exc()
+        results.put( (rid, result) )
+
+
+class ThumbnailAtlas:
+    """Thumbnails of all slides, rendered once in the background:
+        * packed in a few large 16 bits sheets, within a memory limit
+          counted in the image cache budget
+        * scaled to the size needed by the overview or a preview,
+          the last scaled thumbnails are kept
+        * kept for unchanged slides when the document is reloaded
+        * rendered from the focus outwards
+    """
+
+    def __init__(self, doc, callback=None):
+        self.doc = doc
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.sheets = []
+        self.cells = {}
+        self.scaled = collections.OrderedDict()
+        self.free = []
+        self.count = 0
+        sheet_size = ATLAS_CELLS*THUMB_WIDTH * ATLAS_CELLS*THUMB_HEIGHT * 2
+        self.max_cells = ATLAS_CELLS*ATLAS_CELLS * max(1, min(ATLAS_SIZE, doc.cache.budget // 4) // sheet_size)
+        self.tried = set()
+        self.center = 0
+        # next slides to try above and below the focus
+        self.hi = 0
+        self.lo = -1
+        self.running = False
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self):
+        "Background thread: render the slides as they are scanned"
+        while True:
+            doc = self.doc
+            complete = doc.complete
+            info = self.pick()
+            if info is None:
+                if not complete:
+                    time.sleep(0.1)
+                    continue
+                with self.lock:
+                    # keep going if a new version was loaded meanwhile
+                    if doc is self.doc:
+                        self.running = False
+                        break
+                continue
+
+            if info in self.cells:
+                # identical to a slide of the previous version
+                continue
+            try:
+                image = info.load_image(THUMB_WIDTH, THUMB_HEIGHT)
+                if image is not None:
+                    if not self.add(info, image):
+                        with self.lock:
+                            self.running = False
+                        break
+                    if self.callback:
+                        self.callback( (info, False, THUMB_WIDTH, THUMB_HEIGHT) )
+            except:
+                traceback.print_exc()
+
+    def focus(self, n):
+        "Render the thumbnails around the n-th slide first"
+        with self.lock:
+            n = max(0, min(n, len(self.doc.layout)-1))
+            if n != self.center:
+                self.center = n
+                self.hi = n
+                self.lo = n-1
+
+    def pick(self):
+        "Next slide to render: the closest to the focus"
+        with self.lock:
+            layout = self.doc.layout
+            n = len(layout)
+            # the cursors only move away from the focus: slides added meanwhile are found above
+            while self.lo >= 0 or self.hi < n:
+                if self.hi < n and (self.lo < 0 or self.hi - self.center <= self.center - self.lo):
+                    i = self.hi
+                    self.hi += 1
+                else:
+                    i = self.lo
+                    self.lo -= 1
+                if i not in self.tried:
+                    self.tried.add(i)
+                    return layout[i]
+            return None
+
+    def get_slot(self):
+        "A free cell, or one only used by an older version of the document, None when full"
+        if self.free:
+            return self.free.pop()
+        if self.count < self.max_cells:
+            self.count += 1
+            return self.count - 1
+        used = set( cell[2] for info, cell in self.cells.items() if info.doc is self.doc )
+        for info, cell in list(self.cells.items()):
+            if cell[2] not in used:
+                slot = cell[2]
+                for other in [ other for other, c in self.cells.items() if c[2] == slot ]:
+                    del self.cells[other]
+                return slot
+        return None
+
+    def add(self, info, image):
+        "Store a thumbnail, False if the atlas is full"
+        w = min(image.width(), THUMB_WIDTH)
+        h = min(image.height(), THUMB_HEIGHT)
+        with self.lock:
+            slot = self.get_slot()
+            if slot is None:
+                return False
+            sheet_index, cell = divmod(slot, ATLAS_CELLS*ATLAS_CELLS)
+            row, col = divmod(cell, ATLAS_CELLS)
+            x = col * THUMB_WIDTH
+            y = row * THUMB_HEIGHT
+            while len(self.sheets) <= sheet_index:
+                sheet = QtGui.QImage(ATLAS_CELLS*THUMB_WIDTH, ATLAS_CELLS*THUMB_HEIGHT, QtGui.QImage.Format_RGB16)
+                sheet.fill(0)
+                self.sheets.append(sheet)
+                self.doc.cache.reserve(sheet.byteCount())
+            qp = QtGui.QPainter()
+            qp.begin(self.sheets[sheet_index])
+            qp.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            qp.drawImage(x, y, image, 0, 0, w, h)
+            qp.end()
+            self.cells[info] = (sheet_index, QtCore.QRect(x, y, w, h), slot)
+        return True
+
+    def set_document(self, doc):
+        "Fill the thumbnails of a new version of the document"
+        with self.lock:
+            self.doc = doc
+            self.tried = set()
+            self.hi = self.center
+            self.lo = self.center-1
+        self.start()
+
+    def share(self, old, new):
+        "Use the thumbnail of a slide for an identical one"
+        with self.lock:
+            cell = self.cells.get(old)
+            if cell is not None:
+                self.cells[new] = cell
+
+    def forget(self, doc):
+        "Release the cells only used by an old version of the document"
+        with self.lock:
+            for key in [ key for key in self.scaled if key[0].doc is doc ]:
+                del self.scaled[key]
+            used = set( cell[2] for info, cell in self.cells.items() if info.doc is not doc )
+            for info in [ info for info in self.cells if info.doc is doc ]:
+                slot = self.cells.pop(info)[2]
+                if slot not in used:
+                    used.add(slot)
+                    self.free.append(slot)
+
+    def get(self, info, width=None, height=None):
+        "Extract the thumbnail of a slide, scaled to fit the given size"
+        key = (info, width, height)
+        with self.lock:
+            image = self.scaled.pop(key, None)
+            if image is not None:
+                self.scaled[key] = image
+                return image
+            cell = self.cells.get(info)
+            if cell is None:
+                return None
+            sheet_index, rect, slot = cell
+            image = self.sheets[sheet_index].copy(rect)
+        if width and height:
+            image = image.scaled(width, height, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        with self.lock:
+            self.scaled[key] = image
+            while len(self.scaled) > ATLAS_SCALED:
+                self.scaled.popitem(False)
+        return image
+
+
+class RenderEngine(QtCore.QObject):
+    """Render pages in the background:
+        * prepare the images needed around the current slide
+        * serve them from the cache (hit) or render them on demand (miss)
+    """
+
+    # emitted with the (info, note, width, height) key of each new image
+    rendered = QtCore.pyqtSignal(object)
+
+    def __init__(self, doc, depth=PREFETCH_DEPTH):
+        super(RenderEngine, self).__init__()
+        self.doc = doc
+        self.cache = doc.cache
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        # keys of the last prefetch, and images asked for on the way (overview, previews)
+        self.wanted = set()
+        self.queued = set()
+        self.pending = {}
+        self.placeholders = {}
+
+        # poppler calls are serialized on the document lock: one worker is enough,
+        # unless they are dispatched to render processes
+        self.pool = QtCore.QThreadPool()
+        if doc.server:
+            self.pool.setMaxThreadCount(doc.server.processes)
+        else:
+            self.pool.setMaxThreadCount(1)
+
+        self.atlas = ThumbnailAtlas(doc, self.rendered.emit)
+
+    def get_image(self, info, width, height, note=False):
+        key = (info, note, width, height)
+        with self.lock:
+            # wait for a prefetch already in flight rather than rendering twice
+            while key in self.pending and (key in self.wanted or key in self.queued):
+                self.done.wait()
+
+        image = self.cache.get(key)
+        if image is None:
+            image = self.derive(key)
+            if image is None:
+                image = info.load_image(width, height, note)
+            self.cache.add(key, image)
+        return image
+
+    def get_preview(self, info, width, height, note=False):
+        """Return the final image if it is available, or a quick preview.
+        The final image is then rendered in the background.
+        """
+        key = (info, note, width, height)
+        if not PROGRESSIVE:
+            return self.get_image(info, width, height, note), True
+        image = self.peek(info, width, height, note)
+        if image is not None:
+            return image, True
+
+        # scale up any other size from the cache or atlas, never render in the calling thread
+        preview = self.cache.find(info, note)
+        if preview is None and not note:
+            preview = self.atlas.get(info)
+        if preview is not None:
+            preview = preview.scaled(width, height, QtCore.Qt.KeepAspectRatio, QtCore.Qt.FastTransformation)
+        else:
+            image = info.load_cached(width, height, note)
+            if image is not None:
+                self.cache.add(key, image)
+                return image, True
+            preview = self.get_placeholder(info, width, height, note)
+
+        self.queue(key)
+        return preview, False
+
+    def get_placeholder(self, info, width, height, note=False):
+        "Blank image of the size of the final one"
+        area = info.get_area(width, height, note)
+        if area is None:
+            return None
+        size = ( int(area[4]), int(area[5]) )
+        image = self.placeholders.get(size)
+        if image is None:
+            image = QtGui.QImage(size[0], size[1], QtGui.QImage.Format_RGB32)
+            image.fill(PLACEHOLDER)
+            self.placeholders[size] = image
+        return image
+
+    def peek(self, info, width, height, note=False):
+        "The final image if it is cached or can be scaled from a larger one, None rather than rendering"
+        key = (info, note, width, height)
+        image = self.cache.get(key)
+        if image is None:
+            image = self.derive(key)
+            self.cache.add(key, image)
+        return image
+
+    def get_thumbnail(self, info, width, height):
+        """Like get_preview, but never renders in the calling thread:
+        small images are scaled from the atlas, larger ones are queued.
+        """
+        key = (info, False, width, height)
+        image = self.cache.get(key)
+        if image is not None:
+            return image, True
+
+        preview = self.atlas.get(info, width, height)
+        if preview is not None and width <= THUMB_WIDTH and height <= THUMB_HEIGHT:
+            self.cache.add(key, preview)
+            return preview, True
+        if preview is None:
+            preview = self.cache.find(info, False)
+            if preview is not None:
+                preview = preview.scaled(width, height, QtCore.Qt.KeepAspectRatio, QtCore.Qt.FastTransformation)
+
+        self.queue(key)
+        return preview, False
+
+    def set_document(self, doc):
+        "Switch to a new version of the document"
+        with self.lock:
+            self.wanted = set()
+            self.queued = set()
+        # the renders queued for the old version are skipped
+        self.pool.waitForDone()
+        self.doc = doc
+        self.cache = doc.cache
+        if doc.server:
+            self.pool.setMaxThreadCount(doc.server.processes)
+        else:
+            self.pool.setMaxThreadCount(1)
+        self.atlas.set_document(doc)
+
+    def share(self, old, new, note):
+        "Reuse the images of an unchanged page for its new version"
+        self.cache.share(old, new, note)
+        if not note:
+            self.atlas.share(old, new)
+
+    def forget(self, doc):
+        "Drop the images of an old version of the document"
+        self.cache.forget(doc)
+        self.atlas.forget(doc)
+
+    def queue(self, key):
+        """Render an image in the background, unless it is already on its way.
+        It is kept through the next prefetches, after them and closest to the overview selection first.
+        """
+        with self.lock:
+            self.queued.add(key)
+            if key not in self.pending:
+                task = RenderTask(self, [key])
+                self.pending[key] = task
+                self.pool.start(task, -abs(key[0].n - self.atlas.center))
+
+    def derive(self, key, source=None):
+        """Scale a larger image of the same page down to the requested size.
+        Returns None when no large enough image is available.
+        """
+        info, note, width, height = key
+        if source is None:
+            source = self.cache.find(info, note)
+        if source is None or source.isNull():
+            return None
+        if width > source.width() and height > source.height():
+            return None
+        return source.scaled(width, height, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+
+    def prefetch(self, requests, pinned=()):
+        """Render the listed (info, width, height, note) in the background.
+        Pinned requests stay in the cache until the next call.
+        """
+        # group the sizes requested by all the views for each page
+        plan = collections.OrderedDict()
+        for info, width, height, note in requests:
+            key = (info, note, width, height)
+            keys = plan.setdefault( (info, note), [] )
+            if key not in keys:
+                keys.append(key)
+        self.cache.pin( [ (info, note, width, height) for info, width, height, note in pinned ] )
+
+        with self.lock:
+            self.wanted = set( key for keys in plan.values() for key in keys )
+            # the first pages are the most urgent
+            for i, keys in enumerate(plan.values()):
+                # render the largest size only, and scale it down for the others
+                keys = [ key for key in sorted(keys, key=lambda k: k[2]*k[3], reverse=True)
+                         if key not in self.pending and not self.cache.contains(key) ]
+                if not keys:
+                    continue
+                task = RenderTask(self, keys)
+                for key in keys:
+                    self.pending[key] = task
+                self.pool.start(task, len(plan) - i)
+
+    def task_done(self, key, image):
+        self.cache.add(key, image)
+        with self.lock:
+            del self.pending[key]
+            self.queued.discard(key)
+            self.done.notify_all()
+        if image is not None:
+            self.rendered.emit(key)
+
+    def is_wanted(self, key):
+        with self.lock:
+            if key not in self.wanted and key not in self.queued:
+                return False
+        return not self.cache.contains(key)
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        if self.doc.disk_cache:
+            stats.update( self.doc.disk_cache.get_stats() )
+        with self.lock:
+            stats["pending"] = len(self.pending)
+        return stats
+
+
+class RenderTask(QtCore.QRunnable):
+    """Render the images of a page in a worker thread:
+    the first (largest) one is rendered, the others are scaled from it.
+    """
+
+    def __init__(self, engine, keys):
+        super(RenderTask, self).__init__()
+        # the engine keeps a reference until completion
+        self.setAutoDelete(False)
+        self.engine = engine
+        self.keys = keys
+
+    def run(self):
+        source = None
+        for key in self.keys:
+            image = None
+            # skip requests that became useless while waiting in the queue
+            if self.engine.is_wanted(key):
+                info, note, width, height = key
+                try:
+                    image = self.engine.derive(key, source)
+                    if image is None:
+                        image = info.load_image(width, height, note)
+                        source = image
+                except:
+                    traceback.print_exc()
+            self.engine.task_done(key, image)
+
+
+def get_neighbours(page, depth):
+    "List the pages reachable in a few moves from the given one, closest first"
+    pages = [page]
+    fwd = bwd = page
+    for i in range(depth):
+        for candidate in (fwd.get_next(True), fwd.get_next(), bwd.get_prev()):
+            if candidate and candidate not in pages:
+                pages.append(candidate)
+        fwd = fwd.get_next() or fwd
+        bwd = bwd.get_prev() or bwd
+    return pages
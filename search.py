@@ -0,0 +1,90 @@
+import re
+import bisect
+import threading
+import traceback
+from PyQt4 import QtCore
+
+
+# maximal number of slides found by a search
+SEARCH_RESULTS = 12
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class TextIndex:
+    """Full text index of the document, built in the background:
+        * maps each word to the slides where it appears (and their first overlay showing it)
+        * each word of a query matches as a prefix, for type-ahead search
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.words = []
+        self.dirty = False
+        self.indexed = 0
+        self.total = 0
+        self.complete = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.build)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def build(self):
+        "Background thread: extract the text of all pages"
+        pages = [ info for info in self.doc.pages if info is not None ]
+        self.total = len(pages)
+        for info in pages:
+            if self.doc.closed:
+                return
+            try:
+                with self.doc.lock:
+                    text = u"%s" % info.page.text(QtCore.QRectF())
+            except:
+                traceback.print_exc()
+                continue
+            words = set( word.lower() for word in WORD.findall(text) )
+            with self.lock:
+                for word in words:
+                    slides = self.postings.setdefault(word, {})
+                    # pages come in order: keep the first overlay showing the word
+                    if info.n not in slides:
+                        slides[info.n] = info
+                self.dirty = True
+                self.indexed += 1
+        self.complete = True
+
+    def search(self, query, limit=SEARCH_RESULTS):
+        """Find the slides containing all words of the query (as prefixes), in slide order.
+        Returns the first slides found and the number of slides found.
+        """
+        terms = [ term.lower() for term in WORD.findall(query) ]
+        if not terms:
+            return [], 0
+
+        found = None
+        with self.lock:
+            if self.dirty:
+                self.words = sorted(self.postings)
+                self.dirty = False
+            for term in terms:
+                slides = {}
+                i = bisect.bisect_left(self.words, term)
+                while i < len(self.words) and self.words[i].startswith(term):
+                    for n, info in self.postings[ self.words[i] ].items():
+                        if n not in slides or info.o_n < slides[n].o_n:
+                            slides[n] = info
+                    i += 1
+
+                if found is None:
+                    found = slides
+                else:
+                    # the first overlay showing all the words so far
+                    found = dict( (n, max(info, slides[n], key=lambda page: page.o_n))
+                                  for n, info in found.items() if n in slides )
+                if not found:
+                    break
+
+        return [ found[n] for n in sorted(found)[:limit] ], len(found)
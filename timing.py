@@ -0,0 +1,102 @@
+import time
+import functools
+
+
+# record timings (can also be toggled from the presenter view)
+ENABLED = False
+
+# number of events kept in the ring buffer
+BUFFER_SIZE = 4096
+
+# save the recorded events in this file when leaving (None to skip)
+DUMP_FILE = None
+
+
+clock = getattr(time, "perf_counter", time.time)
+
+events = [None] * BUFFER_SIZE
+position = 0
+
+# last key press and the widgets painted since
+key_time = None
+painted_since_key = set()
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def record(name, start, end):
+    "Store an event, overwriting the oldest one"
+    # concurrent calls may overwrite each other: losing an event is fine
+    global position
+    i = position
+    position = (i+1) % BUFFER_SIZE
+    events[i] = (name, start, end)
+
+def key_pressed():
+    "Mark the start of a key-to-screen measure"
+    global key_time
+    if ENABLED:
+        key_time = clock()
+        painted_since_key.clear()
+
+def timed(name):
+    "Decorator recording the duration of each call"
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            start = clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(name, start, clock())
+        return wrapper
+    return decorator
+
+def painted(name):
+    """Decorator for paintEvent: record the duration of the paint,
+    and the delay since the last key press for the first paint following it.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            start = clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                end = clock()
+                record("paint "+name, start, end)
+                if key_time is not None and name not in painted_since_key:
+                    painted_since_key.add(name)
+                    record("key to "+name, key_time, end)
+        return wrapper
+    return decorator
+
+
+def get_durations(name):
+    "Durations of the recorded events with the given name, oldest first (ms)"
+    i = position
+    ordered = events[i:] + events[:i]
+    return [ 1000 * (e[2]-e[1]) for e in ordered if e and e[0] == name ]
+
+def get_stats(name):
+    "Last and 95th percentile durations (ms), None if nothing was recorded"
+    durations = get_durations(name)
+    if not durations:
+        return None
+    last = durations[-1]
+    durations.sort()
+    p95 = durations[ min(len(durations)-1, int(0.95*len(durations))) ]
+    return last, p95
+
+def dump(filename):
+    "Save the recorded events as tab separated values (name, start, duration in ms)"
+    with open(filename, "w") as f:
+        for e in sorted( [ e for e in events if e ], key=lambda e: e[1] ):
+            name, start, end = e
+            f.write( "%s\t%.6f\t%.3f\n" % (name, start, 1000*(end-start)) )